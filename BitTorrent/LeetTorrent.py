@@ -1,7 +1,7 @@
 '''
 Simple bittorrent-client. v0.4. OMG IT CAN SEED!!!
 
-Usage: python tor.py [-h] [-o folder] [-ds speed] [-us speed] [-s] file [file ...]
+Usage: python tor.py [-h] [-o folder] [-ds speed] [-us speed] [-s] [-m] [-a] file [file ...]
 Requirements: python v3.4. httplib2 module.
 
 Copyright: (c) 2015 by Koshara Pavel.
@@ -9,6 +9,7 @@ Copyright: (c) 2015 by Koshara Pavel.
 
 import os
 from core.torrent import Torrent, download
+from core import aio
 from argparse import ArgumentParser
 from core.becnode import bendecode
 
@@ -47,6 +48,10 @@ def main():
     parser.add_argument('-s', action='store_true',
                         help='This key tells BitTorent not to stop seeding after '
                         'download is completed.')
+    parser.add_argument('-m', action='store_true',
+                        help='Use memory-mapped files to store downloaded data.')
+    parser.add_argument('-a', action='store_true',
+                        help='Use asyncio network engine instead of threaded one.')
     arguments = parser.parse_args()
     if arguments.ds and arguments.ds < 200:
         print('Download speed limit should be more than 200 KB/s')
@@ -59,11 +64,14 @@ def main():
             print(file_+' doesn\'t exists or you have no permission to read it.')
             del arguments.files[index]
     filesdata = []
+    raw_infos = []
     for file_ in arguments.files:
         with open(file_, 'rb') as tor_file:
             try:
-                data = bendecode(tor_file.read().decode('latin1'))
+                raw = {}
+                data = bendecode(tor_file.read(), raw)
                 filesdata.append(data)
+                raw_infos.append(raw.get('info'))
             except (ValueError, TypeError):
                 print('File '+file_+' is bencoded incorrectly.')
     for data in filesdata:
@@ -71,13 +79,17 @@ def main():
             print('Some of files is invalid.')
             return
     for data in filesdata:
-        print(data['info']['name'].encode('iso8859-1'))
+        print(str(data['info']['name'], 'utf8', 'replace'))
+    torrent_class = aio.AsyncTorrent if arguments.a else Torrent
     torrents = []
     for i in range(0, len(filesdata)):
-        torrents.append(Torrent(arguments.ds, arguments.us))
-        torrents[i].set_up(filesdata[i], arguments.o)
+        torrents.append(torrent_class(arguments.ds, arguments.us, arguments.m))
+        torrents[i].set_up(filesdata[i], arguments.o, raw_infos[i])
         Torrent.torrents_count += 1
-    download(torrents, arguments.ds, arguments.s)
+    if arguments.a:
+        aio.download(torrents, arguments.ds, arguments.s)
+    else:
+        download(torrents, arguments.ds, arguments.s)
 
 if __name__ == '__main__':
     main()
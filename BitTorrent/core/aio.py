@@ -0,0 +1,278 @@
+'''
+Peers, server and download loop driven by asyncio event loop. Protocol
+logic is shared with the threaded engine, only the way data gets to and
+from sockets differs.
+'''
+
+import asyncio
+import time
+from functools import partial
+from core.network import Peer, Server, SEND_CHUNK
+from core.torrent import Torrent, SPEED_DELTA, run, show_download_state, show_seeding_state
+from core.scheduler import REFILL_INTERVAL
+from core.config import ENDGAME_PERCENT, PEER_TIMEOUT, RESUME_INTERVAL
+
+TICK = REFILL_INTERVAL
+PASS_INTERVAL = 0.05
+
+class AsyncPeer(Peer, asyncio.BufferedProtocol):
+    '''
+    Peer that is an asyncio protocol. Transport reads straight into
+    peer's receive buffer, messages are parsed in buffer_updated() and
+    written to the transport. Messages
+    may be pushed from other threads (e.g. have messages sent after piece
+    was written to disk), so they are flushed in the loop thread.
+    '''
+    def __init__(self, handshake, upload=False, sock=None, swarm=None, notify=None):
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.notify = notify
+        self.paused = False
+        super().__init__(handshake, upload, sock, swarm)
+
+    def attach(self, sock):
+        '''
+        Wrap socket of incoming connection into transport.
+        '''
+        self.sock = sock
+        if sock is not None:
+            self.loop.create_task(self.loop.connect_accepted_socket(lambda: self, sock))
+
+    def detach(self):
+        '''
+        Close transport or socket that hasn't got it yet.
+        '''
+        if self.transport is not None:
+            self.transport.close()
+        elif self.sock is not None:
+            self.sock.close()
+
+    def connect(self, ip_address, port):
+        '''
+        Start connecting to given ip_address using given port.
+        '''
+        self.loop.create_task(self.open_connection(ip_address, port))
+
+    async def open_connection(self, ip_address, port):
+        '''
+        Connect to peer. Peer is closed if it can't be reached in time.
+        '''
+        try:
+            await asyncio.wait_for(
+                self.loop.create_connection(lambda: self, ip_address, port), PEER_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError):
+            self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.alive:
+            transport.close()
+            return
+        transport.set_write_buffer_limits(SEND_CHUNK)
+        self.connected = True
+        if not self.upload:
+            self.push(self.handshake)
+        self.send()
+
+    def get_buffer(self, sizehint):
+        return self.recv_space()
+
+    def buffer_updated(self, nbytes):
+        self.recv_end += nbytes
+        messages = self.parse_stream()
+        if messages:
+            self.handle_messages(messages)
+            if self.notify is not None:
+                self.notify()
+
+    def connection_lost(self, exc):
+        if self.alive:
+            self.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.send()
+
+    def start_writing(self):
+        '''
+        Flush queued messages in the next loop iteration, so messages pushed
+        together are written at once.
+        '''
+        self.loop.call_soon_threadsafe(self.send)
+
+    def send(self):
+        '''
+        Write control messages to transport, then piece messages until
+        transport's buffer is full (it pauses writing). Pieces that are
+        left wait in bulk queue, so control messages don't queue behind them.
+        '''
+        if self.transport is None or self.transport.is_closing():
+            return
+        with self.lock:
+            self.writing = False
+            control = list(self.control)
+            self.control.clear()
+        for message in control:
+            self.transport.writelines(message)
+        while not self.paused:
+            with self.lock:
+                if not self.bulk:
+                    break
+                message = self.bulk.popleft()
+            self.transport.writelines(message)
+
+class AsyncServer(Server):
+    '''
+    Server which socket is watched by asyncio event loop. Loop is not
+    running yet when server is created, so watching starts in start().
+    '''
+    def attach(self):
+        self.loop = None
+
+    def start(self):
+        '''
+        Start accepting connections. Must be called from running loop.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.sock, self.accept)
+
+    def detach(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.sock)
+
+class AsyncTorrent(Torrent):
+    '''
+    Torrent with asyncio peers. Trackers are announced in executor and
+    peers wake the download loop up when they receive something. Blocks
+    are uploaded from executor too, transports can't mix sendfile with
+    writes, so they are read into memory.
+    '''
+    server_class = AsyncServer
+    use_sendfile = False
+
+    def __init__(self, speed_limit, upload_limit, use_mmap=False):
+        super().__init__(speed_limit, upload_limit, use_mmap)
+        self.wakeup = None
+        self.announcing = set()
+
+    def new_peer(self, upload=False, sock=None):
+        notify = self.wakeup.set if self.wakeup is not None else None
+        return AsyncPeer(self.handshake, upload, sock, self.picker, notify)
+
+    def announce(self):
+        '''
+        Announce to trackers in executor, so slow trackers don't block the loop.
+        '''
+        loop = asyncio.get_running_loop()
+        for tracker in self.trackers:
+            if tracker in self.announcing or not tracker.can_reannounce():
+                continue
+            self.announcing.add(tracker)
+            future = loop.run_in_executor(None, tracker.get_peers)
+            future.add_done_callback(partial(self.announced, tracker))
+
+    def announced(self, tracker, future):
+        '''
+        Connect to peers returned by tracker.
+        '''
+        self.announcing.discard(tracker)
+        if not future.cancelled() and future.exception() is None:
+            self.add_addresses(future.result())
+
+def close_all(torrents):
+    '''
+    Close servers and peers of torrents.
+    '''
+    for torrent in torrents:
+        torrent.server.close()
+        for peer in torrent.peers:
+            peer.close()
+
+async def start(torrents, wakeup):
+    '''
+    Start servers and connect to peers.
+    '''
+    for torrent in torrents:
+        torrent.wakeup = wakeup
+        torrent.server.start()
+        torrent.update_peer_list(True)
+        torrent.start_time = time.time()
+
+async def wait(wakeup, since):
+    '''
+    Wait until some peer receives a whole message or TICK seconds pass
+    since the last pass (started at since). Passes are at least
+    PASS_INTERVAL apart, so the loop doesn't spin while data flows.
+    '''
+    delay = since + PASS_INTERVAL - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    try:
+        await asyncio.wait_for(wakeup.wait(), max(0, since + TICK - time.time()))
+    except asyncio.TimeoutError:
+        pass
+    wakeup.clear()
+
+async def process_download(torrents, length, downloaded, speed_limit, wakeup):
+    '''
+    Download file. Peers are checked whenever any of them receives data.
+    Pieces are hashed by hash pool of torrents while they are downloaded and
+    written by disk writer thread, saving resume files is done in executor.
+    '''
+    print('Download started')
+    loop = asyncio.get_running_loop()
+    start_time = time.time() - 0.1
+    speed = 0
+    while downloaded < length:
+        pass_time = time.time()
+        endgame = round(100*(downloaded)/length, 2) > ENDGAME_PERCENT
+        for torrent in torrents:
+            need_peers = not speed_limit or speed < speed_limit + SPEED_DELTA
+            torrent.update_peer_list(need_peers)
+            completed_pieces = torrent.check_peers(endgame)
+            await loop.run_in_executor(None, torrent.send_blocks_to_peers)
+            torrent.insert_pieces(completed_pieces)
+            torrent.finish_writes()
+            if time.time() - torrent.resume_time > RESUME_INTERVAL:
+                await loop.run_in_executor(None, torrent.save_resume)
+        downloaded, speed = show_download_state(torrents, length, start_time)
+        await wait(wakeup, pass_time)
+
+async def process_seeding(torrents, wakeup):
+    '''
+    When download completed, this coroutine continues to seed to peers.
+    '''
+    print('Seeding started. Press Ctrl+C to interrupt.')
+    loop = asyncio.get_running_loop()
+    start_time = pass_time = time.time()
+    while True:
+        await wait(wakeup, pass_time)
+        pass_time = time.time()
+        for torrent in torrents:
+            torrent.update_peer_list(False)
+            await loop.run_in_executor(None, torrent.send_blocks_to_peers)
+        show_seeding_state(torrents, start_time)
+
+def download(torrents, speed_limit, seed):
+    '''
+    Start and stop process of downloading in one asyncio event loop.
+    '''
+    loop = asyncio.new_event_loop()
+    wakeup = asyncio.Event()
+    def close():
+        close_all(torrents)
+        loop.run_until_complete(asyncio.sleep(0))
+    try:
+        run(
+            torrents, seed, lambda: loop.run_until_complete(start(torrents, wakeup)),
+            lambda length, downloaded: loop.run_until_complete(
+                process_download(torrents, length, downloaded, speed_limit, wakeup)
+            ),
+            lambda: loop.run_until_complete(process_seeding(torrents, wakeup)), close
+        )
+    finally:
+        loop.close()
@@ -2,112 +2,239 @@
 Decode bencoded string and encode objects to bencoded string.
 '''
 
-def bendecode(string):
+def bendecode(data, raw=None):
     '''
-    Decode benencoded object.
+    Decode benencoded object. Data may be bytes, bytearray or memoryview.
+    Strings are returned as read-only memoryview slices of data, so piece
+    hashes and peer lists are never copied. Dictionary keys are returned
+    as str.
+    If raw is a dictionary and data is a bencoded dictionary, raw will be
+    filled with memoryview slices holding the original bencoded value of
+    each top-level key (e.g. raw['info'] for info_hash).
     '''
-    if not isinstance(string, str):
-        raise TypeError('Can\'t decode \'{}\' object. Must be \'str\''.format(type(string)))
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    if not isinstance(data, bytes):
+        raise TypeError('Can\'t decode \'{}\' object. Must be bytes-like'.format(type(data)))
+    view = memoryview(data)
     try:
-        return DECODE_FUNCS[string[0]](string, 0)[0]
+        if raw is not None and view[0] == DICT:
+            return decode_dict(view, 0, raw)[0]
+        return DECODE_FUNCS[view[0]](view, 0)[0]
     except (ValueError, KeyError, IndexError):
         raise ValueError('Invalid bencoded string.')
 
-def decode_str(string, pos):
+def decode_str(view, pos):
     '''
     Decode benencoded string.
     '''
-    leng = string[pos:string.index(':', pos)]
-    pos += len(leng)+1
-    return string[pos:pos+int(leng)], pos+int(leng)
+    colon = view.obj.index(b':', pos)
+    end = colon + 1 + int(view.obj[pos:colon])
+    if end > len(view):
+        raise ValueError('String is out of bounds.')
+    return view[colon+1:end], end
 
-def decode_int(string, pos):
+def decode_int(view, pos):
     '''
     Decode benencoded number.
     '''
-    return int(string[pos+1:string.index('e', pos)]), string.index('e', pos)+1
+    end = view.obj.index(b'e', pos)
+    return int(view.obj[pos+1:end]), end+1
 
-def decode_list(string, pos):
+def decode_list(view, pos):
     '''
     Decode benencoded list.
     '''
     result = []
     pos += 1
-    while string[pos] != 'e':
-        element, pos = DECODE_FUNCS[string[pos]](string, pos)
+    while view[pos] != END:
+        element, pos = DECODE_FUNCS[view[pos]](view, pos)
         result.append(element)
     return result, pos+1
 
-def decode_tuple(string, pos):
+def decode_tuple(view, pos):
     '''
     Decode benencoded tuple.
     '''
     result = []
     pos += 1
-    while string[pos] != 'e':
-        element, pos = DECODE_FUNCS[string[pos]](string, pos)
+    while view[pos] != END:
+        element, pos = DECODE_FUNCS[view[pos]](view, pos)
         result.append(element)
     return tuple(result), pos+1
 
-def decode_dict(string, pos):
+def decode_dict(view, pos, raw=None):
     '''
-    Decode benencoded dictionary.
+    Decode benencoded dictionary. Raw values are stored in raw if it is given.
     '''
     result = {}
     pos += 1
-    while string[pos] != 'e':
-        key, pos = DECODE_FUNCS[string[pos]](string, pos)
-        result[key], pos = DECODE_FUNCS[string[pos]](string, pos)
+    while view[pos] != END:
+        key, pos = DECODE_FUNCS[view[pos]](view, pos)
+        if isinstance(key, memoryview):
+            key = str(key, 'latin-1')
+        start = pos
+        result[key], pos = DECODE_FUNCS[view[pos]](view, pos)
+        if raw is not None:
+            raw[key] = view[start:pos]
     return result, pos+1
 
 def benencode(data):
     '''
-    Encode object using bencode.
+    Encode object using bencode. Return bytes.
     '''
+    result = bytearray()
+    bendump(data, result)
+    return bytes(result)
+
+def bendump(data, sink):
+    '''
+    Encode object using bencode and write it into sink. Sink may be
+    bytearray or any object that has write() method (e.g. file or socket.makefile()).
+    '''
+    write = sink.extend if isinstance(sink, bytearray) else sink.write
     try:
-        return ENCODE_FUNCS[type(data)](data)
+        ENCODE_FUNCS[type(data)](data, write)
     except KeyError:
         raise TypeError('Can\'t encode \'{}\' object.'.format(type(data)))
 
-def encode_list(list_):
+def encode_list(list_, write):
     '''
     Encode list using bencode.
     '''
-    result = 'l'
+    write(b'l')
     for elem in list_:
-        result += ENCODE_FUNCS[type(elem)](elem)
-    return result+'e'
+        ENCODE_FUNCS[type(elem)](elem, write)
+    write(b'e')
 
-def encode_tuple(tuple_):
+def encode_tuple(tuple_, write):
     '''
     Encode tuple using bencode.
     '''
-    result = 't'
+    write(b't')
     for elem in tuple_:
-        result += ENCODE_FUNCS[type(elem)](elem)
-    return result+'e'
+        ENCODE_FUNCS[type(elem)](elem, write)
+    write(b'e')
 
-def encode_str(string):
+def encode_str(string, write):
     '''
-    Encode string using bencode.
+    Encode string using bencode. String is encoded to utf-8.
     '''
-    return str(len(string))+':'+string
+    encode_bytes(string.encode('utf8'), write)
 
-def encode_dict(dic):
+def encode_bytes(data, write):
     '''
-    Encode dictionary using bencode.
+    Encode bytes-like object using bencode.
     '''
-    result = 'd'
+    write(b'%d:' % len(data))
+    write(data)
+
+def encode_dict(dic, write):
+    '''
+    Encode dictionary using bencode. Str keys are encoded to latin-1,
+    the same way bendecode decodes them.
+    '''
+    write(b'd')
     for key, val in sorted(dic.items()):
-        result += ENCODE_FUNCS[type(key)](key)+ENCODE_FUNCS[type(val)](val)
-    return result+'e'
+        if isinstance(key, str):
+            key = key.encode('latin-1')
+        ENCODE_FUNCS[type(key)](key, write)
+        ENCODE_FUNCS[type(val)](val, write)
+    write(b'e')
 
-def encode_int(number):
+def encode_int(number, write):
     '''
     Encode number using bencode.
     '''
-    return 'i'+str(number)+'e'
+    write(b'i%de' % number)
+
+
+class StreamDecoder(object):
+    '''
+    Incremental bencode decoder. Feed it chunks of data as they arrive (e.g. from
+    socket) and call get() to take decoded values. Position and partially
+    decoded containers are kept between calls, so nothing is parsed twice.
+    Unlike bendecode, strings are returned as bytes.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.stack = []
+
+    def feed(self, chunk):
+        '''
+        Add received chunk of data.
+        '''
+        self.buffer += chunk
+
+    def get(self):
+        '''
+        Return next decoded value or NEED_MORE if it hasn't been received completely yet.
+        '''
+        buffer = self.buffer
+        while self.pos < len(buffer):
+            char = buffer[self.pos]
+            if char in (LIST, DICT, TUPLE):
+                self.stack.append([char, {} if char == DICT else [], None])
+                self.pos += 1
+                continue
+            if char == END:
+                if not self.stack or self.stack[-1][2] is not None:
+                    raise ValueError('Invalid bencoded string.')
+                type_, value, _ = self.stack.pop()
+                self.pos += 1
+                if type_ == TUPLE:
+                    value = tuple(value)
+            elif char == INT:
+                end = buffer.find(b'e', self.pos)
+                if end == -1:
+                    break
+                value = self.to_int(buffer[self.pos+1:end])
+                self.pos = end+1
+            elif char in DIGITS:
+                colon = buffer.find(b':', self.pos)
+                if colon == -1:
+                    break
+                end = colon + 1 + self.to_int(buffer[self.pos:colon])
+                if end > len(buffer):
+                    break
+                value = bytes(buffer[colon+1:end])
+                self.pos = end
+            else:
+                raise ValueError('Invalid bencoded string.')
+            if not self.stack:
+                del buffer[:self.pos]
+                self.pos = 0
+                return value
+            self.put(value)
+        del buffer[:self.pos]
+        self.pos = 0
+        return NEED_MORE
+
+    def put(self, value):
+        '''
+        Put decoded value into the innermost container.
+        '''
+        container = self.stack[-1]
+        if container[0] != DICT:
+            container[1].append(value)
+        elif container[2] is None:
+            if not isinstance(value, bytes):
+                raise ValueError('Invalid bencoded string.')
+            container[2] = str(value, 'latin-1')
+        else:
+            container[1][container[2]] = value
+            container[2] = None
 
+    @staticmethod
+    def to_int(digits):
+        '''
+        Convert bytes to int raising ValueError if bytes are not a number.
+        '''
+        try:
+            return int(digits)
+        except ValueError:
+            raise ValueError('Invalid bencoded string.')
 
 ENCODE_FUNCS = {}
 ENCODE_FUNCS[tuple] = encode_tuple
@@ -115,10 +242,20 @@ ENCODE_FUNCS[list] = encode_list
 ENCODE_FUNCS[dict] = encode_dict
 ENCODE_FUNCS[int] = encode_int
 ENCODE_FUNCS[str] = encode_str
+ENCODE_FUNCS[bytes] = encode_bytes
+ENCODE_FUNCS[bytearray] = encode_bytes
+ENCODE_FUNCS[memoryview] = encode_bytes
+NEED_MORE = object()
+END = ord('e')
+DICT = ord('d')
+TUPLE = ord('t')
+LIST = ord('l')
+INT = ord('i')
+DIGITS = b'0123456789'
 DECODE_FUNCS = {}
-DECODE_FUNCS['t'] = decode_tuple
-DECODE_FUNCS['l'] = decode_list
-DECODE_FUNCS['d'] = decode_dict
-DECODE_FUNCS['i'] = decode_int
-for i in range(0, 10):
-    DECODE_FUNCS[str(i)] = decode_str
+DECODE_FUNCS[TUPLE] = decode_tuple
+DECODE_FUNCS[LIST] = decode_list
+DECODE_FUNCS[DICT] = decode_dict
+DECODE_FUNCS[INT] = decode_int
+for i in DIGITS:
+    DECODE_FUNCS[i] = decode_str
@@ -0,0 +1,97 @@
+'''
+A cache of pieces read from disk for uploading.
+'''
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from core.config import PIECE_CACHE_SIZE
+
+PREFETCH_PIECES = 2
+
+class PieceCache(object):
+    '''
+    Pieces of all torrents that were read to be sent to peers, keyed by
+    (torrent, index). Total size is bounded, the least recently used pieces
+    are evicted first. When pieces of a torrent are read one after another,
+    the next ones are read in background before peers ask for them.
+    '''
+    def __init__(self, max_size=PIECE_CACHE_SIZE, prefetch=PREFETCH_PIECES):
+        self.max_size = max_size
+        self.prefetch_count = prefetch
+        self.pieces = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.last = {}
+        self.loading = set()
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get(self, owner, index, load):
+        '''
+        Return piece with given index of owner (torrent). If it isn't cached,
+        it is loaded by load(index), which returns None for pieces that
+        can't be read.
+        '''
+        key = (owner, index)
+        with self.lock:
+            data = self.pieces.get(key)
+            if data is not None:
+                self.pieces.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            sequential = self.last.get(owner) == index - 1
+            self.last[owner] = index
+        if data is None:
+            data = load(index)
+            self.put(key, data)
+        if sequential and self.prefetch_count:
+            self.prefetch(owner, index, load)
+        return data
+
+    def put(self, key, data):
+        '''
+        Add piece to cache and evict the least recently used ones if cache is too big.
+        '''
+        if data is None or len(data) > self.max_size:
+            return
+        with self.lock:
+            if key in self.pieces:
+                return
+            self.pieces[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self.pieces.popitem(last=False)[1])
+
+    def prefetch(self, owner, index, load):
+        '''
+        Load pieces that follow the given one in background.
+        '''
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(1)
+            for key in [(owner, x) for x in range(index+1, index+1+self.prefetch_count)]:
+                if key not in self.pieces and key not in self.loading:
+                    self.loading.add(key)
+                    self.executor.submit(self.preload, key, load)
+
+    def preload(self, key, load):
+        '''
+        Load piece into cache. Runs in background thread.
+        '''
+        try:
+            self.put(key, load(key[1]))
+        finally:
+            with self.lock:
+                self.loading.discard(key)
+
+    def forget(self, owner):
+        '''
+        Remove all pieces of owner.
+        '''
+        with self.lock:
+            for key in [x for x in self.pieces if x[0] is owner]:
+                self.size -= len(self.pieces.pop(key))
+            self.last.pop(owner, None)
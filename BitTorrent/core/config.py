@@ -21,3 +21,11 @@ KEY = random.randint(1, 10000)
 MAX_PEERS = int(CONFIG['DEFAULT']['MaxPeers'])
 UPLOAD_PEERS = 20
 ENDGAME_PERCENT = float(CONFIG['DEFAULT']['EndgamePercent'])
+MAX_OPEN_FILES = int(CONFIG['DEFAULT']['MaxOpenFiles'])
+HASH_THREADS = int(CONFIG['DEFAULT']['HashThreads'])
+RESUME_INTERVAL = int(CONFIG['DEFAULT']['ResumeInterval'])
+SNUB_TIME = int(CONFIG['DEFAULT']['SnubTime'])
+PIECE_CACHE_SIZE = int(CONFIG['DEFAULT']['PieceCacheSize'])*1024*1024
+WRITE_QUEUE_SIZE = int(CONFIG['DEFAULT']['WriteQueueSize'])*1024*1024
+FSYNC_INTERVAL = int(CONFIG['DEFAULT']['FsyncInterval'])
+MEMORY_BUDGET = int(CONFIG['DEFAULT']['MemoryBudget'])*1024*1024
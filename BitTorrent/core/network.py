@@ -6,13 +6,35 @@ import struct
 import time
 import threading
 import random
-from select import select
+import selectors
+from collections import deque
+from itertools import islice
+from selectors import EVENT_READ, EVENT_WRITE
 from socket import socket, SOL_SOCKET, SO_REUSEADDR, SO_ERROR
-from collections import OrderedDict
-from errno import EINPROGRESS, EALREADY, EWOULDBLOCK
+from errno import EINPROGRESS, EALREADY, EWOULDBLOCK, EISCONN
 from core.config import MAX_REQUEST, PEER_TIMEOUT, PORT
+from core.pieces import get_bit, set_bit
+from core.scheduler import MIN_WINDOW
+from core.storage import IOV_MAX, FileSpan, split_buffers
+try:
+    from socket import MSG_MORE
+except ImportError:
+    MSG_MORE = 0
 
 HANDSHAKE_LEN = 68
+PROTOCOL = b'\x13BitTorrent protocol'
+SELECT_TIMEOUT = 1
+BLOCK_MESSAGE_LEN = MAX_REQUEST + 13
+RECV_BUFFER_SIZE = 4*BLOCK_MESSAGE_LEN
+MAX_MESSAGE_LEN = 2**21
+SEND_CHUNK = 4*BLOCK_MESSAGE_LEN
+LENGTH = struct.Struct('!I')
+BLOCK_HEADER = struct.Struct('!II')
+BLOCK_REQUEST = struct.Struct('!III')
+HEADER = struct.Struct('!IB')
+HAVE = struct.Struct('!IBI')
+REQUEST = struct.Struct('!IBIII')
+PIECE_HEADER = struct.Struct('!IBII')
 MESSAGES = {
     'keep-alive': b'\x00\x00\x00\x00',
     'choke': b'\x00\x00\x00\x01\x00',
@@ -28,61 +50,79 @@ MESSAGES = {
 
 class SocketHandler():
     '''
-    Call select() for all sockets of Server and Peer instances created in
-    currently executing program.
+    Wait for events on sockets of Server and Peer instances created in
+    currently executing program. Sockets are registered in selector (epoll
+    on Linux), so waiting doesn't depend on number of sockets. Write
+    interest is registered only while there is something to send.
     '''
-    socket_map = {}
+    selector = selectors.DefaultSelector()
     alive = True
 
     @staticmethod
     def loop():
         '''
-        Infite loop calling select().
+        Infinite loop waiting for events and handling them.
         '''
         while SocketHandler.alive:
-            filenos = list(SocketHandler.socket_map.keys())
-            if filenos == []:
-                time.sleep(0.001)
-                continue
-            for fileno in filenos:
-                try:
-                    if not SocketHandler.socket_map[fileno].alive:
-                        del SocketHandler.socket_map[fileno]
-                except KeyError:
-                    pass
             try:
-                SocketHandler.handle_sockets(*select(filenos, filenos, filenos, 3))
+                events = SocketHandler.selector.select(SELECT_TIMEOUT)
             except OSError:
-                pass
-            time.sleep(0.001)
+                continue
+            for key, mask in events:
+                SocketHandler.handle_socket(key.data, mask)
 
     @staticmethod
-    def handle_sockets(read, write, exc):
+    def handle_socket(obj, mask):
         '''
-        Call appropriate methods for sockets.
+        Call appropriate methods for socket that is ready.
         '''
-        for sock in read:
-            obj = SocketHandler.socket_map.get(sock)
+        if mask & EVENT_READ:
             if isinstance(obj, Server):
                 obj.accept()
             elif isinstance(obj, Peer):
                 obj.recv()
-        for sock in write:
-            obj = SocketHandler.socket_map.get(sock)
-            if isinstance(obj, Peer):
-                obj.send()
-        for sock in exc:
-            obj = SocketHandler.socket_map.get(sock)
-            if obj is not None:
-                obj.close()
+        if mask & EVENT_WRITE and obj.alive and isinstance(obj, Peer):
+            obj.send()
+
+    @staticmethod
+    def register(obj, write=False):
+        '''
+        Start waiting for events on socket of obj.
+        '''
+        events = EVENT_READ | EVENT_WRITE if write else EVENT_READ
+        try:
+            SocketHandler.selector.register(obj.sock, events, obj)
+        except KeyError:
+            SocketHandler.selector.modify(obj.sock, events, obj)
+
+    @staticmethod
+    def set_writing(obj, write):
+        '''
+        Add or remove write interest for socket of registered obj.
+        '''
+        events = EVENT_READ | EVENT_WRITE if write else EVENT_READ
+        try:
+            SocketHandler.selector.modify(obj.sock, events, obj)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    @staticmethod
+    def unregister(obj):
+        '''
+        Stop waiting for events on socket of obj.
+        '''
+        try:
+            SocketHandler.selector.unregister(obj.sock)
+        except (KeyError, ValueError):
+            pass
 
     @staticmethod
     def close():
         '''
-        Stop loop().
+        Close all sockets and stop loop().
         '''
-        for obj in list(SocketHandler.socket_map.values()):
-            obj.close()
+        for key in list(SocketHandler.selector.get_map().values()):
+            key.data.close()
         SocketHandler.alive = False
 
 def construct_message(type_, *args):
@@ -93,13 +133,10 @@ def construct_message(type_, *args):
     if len(MESSAGES[type_]) > 3:
         message += MESSAGES[type_]
     else:
-        message += struct.pack('!I', args[0])+MESSAGES[type_]
+        message += LENGTH.pack(args[0])+MESSAGES[type_]
         args = args[1:]
     for arg in args:
-        try:
-            message += struct.pack('!I', arg)
-        except struct.error:
-            message += arg
+        message += LENGTH.pack(arg) if isinstance(arg, int) else arg
     return message
 
 class Server():
@@ -119,24 +156,38 @@ class Server():
         
         self.sock.listen(5)
         self.sock.setblocking(0)
-        SocketHandler.socket_map[self.sock.fileno()] = self
         self.peers = []
         self.alive = True
+        self.attach()
+
+    def attach(self):
+        '''
+        Start waiting for incoming connections.
+        '''
+        SocketHandler.register(self)
 
     def close(self):
         '''
         Close socket.
         '''
         self.alive = False
-        del SocketHandler.socket_map[self.sock.fileno()]
+        self.detach()
         self.sock.close()
 
+    def detach(self):
+        '''
+        Stop waiting for incoming connections.
+        '''
+        SocketHandler.unregister(self)
+
     def accept(self):
         '''
         Accept incoming connection and add new socket to peer queue.
         '''
         try:
             sock = self.sock.accept()
+        except BlockingIOError:
+            return
         except OSError:
             self.close()
             return
@@ -154,45 +205,70 @@ class Peer():
     '''
     A class representing peer.
     '''
-    def __init__(self, handshake, upload=False, sock=None):
-        self.write_buffer = bytearray()
-        self.current_msg = b''
+    def __init__(self, handshake, upload=False, sock=None, swarm=None):
+        self.control = deque()
+        self.bulk = deque()
+        self.wire = deque()
+        self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self.recv_start = 0
+        self.recv_end = 0
+        self.recv_need = 0
         self.handshake = handshake
-        self.piece_buffer = {}
         self.connected = False
         self.unchoked = False
-        self.completed_pieces = {}
         self.handshaked = False
         self.lock = threading.Lock()
-        self.endgame = False
-        self.requests = 0
         self.alive = True
         self.connect_time = time.time()
-        self.current_msg_len = 0
-        self.bitfield = {}
+        self.bitfield = bytearray()
+        self.swarm = swarm
         self.timer = 0
-        self.a = 1
         self.downloaded = 0
+        self.outstanding = {}
+        self.received = []
+        self.window = MIN_WINDOW
+        self.rtt = 0
+        self.rate = 0
+        self.rate_time = time.time()
+        self.rate_bytes = 0
+        self.last_block = time.time()
+        self.snubbed = False
+        self.stalled = False
         self.upload = upload
         self.need_bitfield = False
         self.need_piece = {}
-        self.max_requests = 1
         self.frozen = False
-        self.sock = sock
-        if self.sock is None:
-            self.sock = socket()
+        self.writing = False
+        self.attach(sock)
+
+    def attach(self, sock):
+        '''
+        Set up socket of peer. Sockets of incoming connections are
+        registered at once (they are already connected), new ones - when
+        they start connecting. Socket is made non-blocking before network
+        thread can see it.
+        '''
+        self.sock = sock if sock is not None else socket()
         self.sock.setblocking(0)
-        SocketHandler.socket_map[self.sock.fileno()] = self
+        if sock is not None:
+            self.connected = True
+            SocketHandler.register(self)
 
     def close(self):
         '''
         Close socket.
         '''
         self.alive = False
-        try:
-            del SocketHandler.socket_map[self.sock.fileno()]
-        except KeyError:
-            pass
+        if self.swarm is not None:
+            self.swarm.remove_bitfield(self.bitfield)
+        self.bitfield = bytearray()
+        self.detach()
+
+    def detach(self):
+        '''
+        Unregister and close socket of peer.
+        '''
+        SocketHandler.unregister(self)
         self.sock.close()
 
     def recv(self):
@@ -202,37 +278,109 @@ class Peer():
         if not self.connected:
             self.check_connection()
         try:
-            stream = bytearray(self.sock.recv(MAX_REQUEST))
-        except (ConnectionAbortedError, ConnectionResetError):
+            received = self.sock.recv_into(self.recv_space())
+        except BlockingIOError:
+            return
+        except OSError:
             self.close()
             return
-        if self.timer and self.downloaded and not self.frozen:
-            self.max_requests = round((self.downloaded/(time.time()-self.timer))/MAX_REQUEST)
-            if not self.max_requests:
-                self.max_requests = 1
-        if stream:
-            messages = self.parse_stream(stream)
-            if messages:
-                self.handle_messages(messages)
+        if not received:
+            self.close()
+            return
+        self.recv_end += received
+        messages = self.parse_stream()
+        if messages:
+            self.handle_messages(messages)
 
     def send(self):
         '''
-        Send messages to peer.
+        Send queued messages to peer. Write interest is dropped when
+        everything is sent.
         '''
         if not self.connected:
             self.check_connection()
         with self.lock:
-            if self.write_buffer:
-                sent = self.sock.send(self.write_buffer)
-                self.write_buffer = self.write_buffer[sent:]
+            if not self.wire:
+                self.fill_wire()
+            if self.wire:
+                try:
+                    sent = self.send_wire()
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self.alive = False
+                    sent = 0
+                split_buffers(self.wire, sent)
+            if not (self.wire or self.control or self.bulk) and self.writing:
+                self.writing = False
+                SocketHandler.set_writing(self, False)
+        if not self.alive:
+            self.close()
+
+    def send_wire(self):
+        '''
+        Send the beginning of wire: file span with sendfile or buffers up to
+        the next span with one sendmsg call. Return number of bytes sent.
+        Called with lock held.
+        '''
+        if isinstance(self.wire[0], FileSpan):
+            sent = self.wire[0].send(self.sock.fileno())
+            if not sent:
+                raise OSError('File is shorter than piece')
+            return sent
+        buffers = []
+        for segment in islice(self.wire, IOV_MAX):
+            if isinstance(segment, FileSpan):
+                break
+            buffers.append(segment)
+        flags = MSG_MORE if len(buffers) < len(self.wire) else 0
+        return self.sock.sendmsg(buffers, (), flags)
+
+    def fill_wire(self):
+        '''
+        Move messages that will be sent next to wire: all control messages
+        and then piece messages up to SEND_CHUNK bytes. Control messages
+        pushed later wait only until the wire is sent, not behind all piece
+        messages. Called with lock held.
+        '''
+        while self.control:
+            self.wire.extend(memoryview(x) for x in self.control.popleft())
+        size = 0
+        while self.bulk and size < SEND_CHUNK:
+            message = self.bulk.popleft()
+            self.wire.extend(x if isinstance(x, FileSpan) else memoryview(x) for x in message)
+            size += sum(len(x) for x in message)
+
+    def push(self, *segments, bulk=False):
+        '''
+        Queue message made of segments (bytes-like objects or file spans
+        that aren't copied). Control messages are sent before queued bulk
+        ones (pieces). Nothing is queued for closed peers.
+        '''
+        if not self.alive:
+            return
+        with self.lock:
+            (self.bulk if bulk else self.control).append(segments)
+            if not self.writing and self.connected:
+                self.writing = True
+                self.start_writing()
+
+    def start_writing(self):
+        '''
+        Wait until socket is writable. Called with lock held.
+        '''
+        SocketHandler.set_writing(self, True)
 
     def check_connection(self):
+        '''
+        Check if connection has been established and send handshake.
+        '''
         err = self.sock.getsockopt(SOL_SOCKET, SO_ERROR)
         if err != 0:
             self.close()
+            return
         self.connected = True
-        with self.lock:
-            self.write_buffer += self.handshake
+        self.push(self.handshake)
 
     def is_alive(self):
         '''
@@ -248,11 +396,13 @@ class Peer():
         '''
         errno = self.sock.connect_ex((ip_address, port))
         if errno in (EINPROGRESS, EALREADY, EWOULDBLOCK):
+            SocketHandler.register(self, write=True)
+            self.writing = True
             return
         if errno in (0, EISCONN):
+            SocketHandler.register(self)
             self.connected = True
-            with self.lock:
-                self.write_buffer += self.handshake
+            self.push(self.handshake)
         else:
             self.close()
 
@@ -261,45 +411,66 @@ class Peer():
         Send bitfield to peer.
         '''
         self.need_bitfield = False
-        with self.lock:
-            self.write_buffer += construct_message('bitfield', len(bitfield)+1, bitfield)
+        self.push(HEADER.pack(len(bitfield)+1, 5), bitfield)
 
-    def parse_stream(self, message):
+    def recv_space(self, size=0):
+        '''
+        Return memoryview of free part of receive buffer, at least size bytes
+        long. When there is no room for a block message (or for the message
+        that is being received), unparsed data is moved to the beginning of
+        buffer or buffer grows.
+        '''
+        pending = self.recv_end - self.recv_start
+        need = max(size, BLOCK_MESSAGE_LEN, self.recv_need - pending)
+        if len(self.recv_buffer) - self.recv_end < need:
+            if pending + need > len(self.recv_buffer):
+                buffer = bytearray(max(pending + need, RECV_BUFFER_SIZE))
+                buffer[:pending] = self.recv_buffer[self.recv_start:self.recv_end]
+                self.recv_buffer = buffer
+            else:
+                self.recv_buffer[:pending] = self.recv_buffer[self.recv_start:self.recv_end]
+            self.recv_start, self.recv_end = 0, pending
+        return memoryview(self.recv_buffer)[self.recv_end:]
+
+    def parse_stream(self, data=None):
         '''
         Return list of tuples containing two objects: message id and payload.
-        '''
-        message = self.current_msg + message
-        #handshake received
-        if message[1:20] == b'BitTorrent protocol':
-            self.check_handshake(message)
+        Payloads are memoryviews of receive buffer, so they are valid only
+        until the buffer is filled again. If data is given, it is added to
+        the buffer first, otherwise buffer has been filled by recv_into.
+        '''
+        if data is not None:
+            self.recv_space(len(data))[:len(data)] = data
+            self.recv_end += len(data)
+        buffer, view = self.recv_buffer, memoryview(self.recv_buffer)
+        start, end = self.recv_start, self.recv_end
+        messages = []
+        if not self.handshaked:
+            if end - start < HANDSHAKE_LEN:
+                return messages
+            if view[start:start+len(PROTOCOL)] != PROTOCOL:
+                self.close()
+                return messages
+            self.check_handshake(view[start:start+HANDSHAKE_LEN])
+            if not self.alive:
+                return messages
             if self.upload:
-                with self.lock:
-                    self.write_buffer += self.handshake
+                self.push(self.handshake)
             self.need_bitfield = True
-            message = message[HANDSHAKE_LEN:]
-            if not message:
-                return
-        messages = []
-        while True:
-            if not self.current_msg_len:
-                try:
-                    self.current_msg_len = struct.unpack('!I', message[:4])[0] + 4
-                except struct.error:
-                    if len(message) < 4:
-                        self.current_msg = message
-                        break
-                    else:
-                        self.close()
-            if len(message) < self.current_msg_len:
-                self.current_msg = message
+            start += HANDSHAKE_LEN
+        self.recv_need = 0
+        while end - start >= LENGTH.size:
+            length = LENGTH.unpack_from(buffer, start)[0] + LENGTH.size
+            if length > MAX_MESSAGE_LEN:
+                self.close()
                 break
-            if self.current_msg_len == 4:
-                message = message[self.current_msg_len:]
-                self.current_msg_len = 0
-                continue
-            messages.append((message[4], message[5:self.current_msg_len]))
-            message = message[self.current_msg_len:]
-            self.current_msg_len = 0
+            if end - start < length:
+                self.recv_need = length
+                break
+            if length > LENGTH.size:
+                messages.append((buffer[start+4], view[start+5:start+length]))
+            start += length
+        self.recv_start = start
         return messages
 
     def handle_messages(self, messages):
@@ -317,25 +488,22 @@ class Peer():
                 self.unchoked = True
             #have
             elif msg_id == 4:
-                index = struct.unpack('!I', payload)[0]
-                self.bitfield[index] = True
+                self.add_piece(LENGTH.unpack_from(payload)[0])
             #bitfield
             elif msg_id == 5:
                 self.fill_bitfield(payload)
                 if not self.upload:
-                    with self.lock:
-                        self.write_buffer += construct_message('interested')
+                    self.push(construct_message('interested'))
             #piece (of cake)
             elif msg_id == 7:
                 self.save_block(payload)
             #interested
             elif msg_id == 2:
                 if self.upload:
-                    with self.lock:
-                        self.write_buffer += construct_message('unchoke')
+                    self.push(construct_message('unchoke'))
             #request
             elif msg_id == 6:
-                index, offset, length = struct.unpack('!III', payload)
+                index, offset, length = BLOCK_REQUEST.unpack_from(payload)
                 if index not in self.need_piece:
                     self.need_piece[index] = []
                 self.need_piece[index].append((offset, length))
@@ -344,113 +512,128 @@ class Peer():
         '''
         Send peer 'have' message.
         '''
-        with self.lock:
-            self.write_buffer += construct_message('have', index)
+        self.push(HAVE.pack(5, 4, index))
 
     def check_handshake(self, message):
         '''
         Check if handshake has correct info-hash.
         '''
-        try:
-            message.index(self.handshake[28:48])
+        if message[28:48] == self.handshake[28:48]:
             self.handshaked = True
-        except ValueError:
+        else:
             self.close()
 
     def send_block(self, data, index, offset):
         '''
-        Send block of data to peer.
+        Send block of data (bytes-like object or file span) to peer.
         '''
-        with self.lock:
-            self.write_buffer += construct_message('piece', len(data)+9, index, offset[0], data)
+        self.push(PIECE_HEADER.pack(len(data)+9, 7, index, offset[0]), data, bulk=True)
         del self.need_piece[index][self.need_piece[index].index(offset)]
 
     def save_block(self, message):
         '''
-        Save block or, if completed, piece to buffer. Completed pieces
-        will be written to files in main function.
+        Save received block with time of its arrival. If block was requested
+        with destination buffer, it is copied right there, otherwise it is
+        copied out of receive buffer and put into piece by scheduler.
         '''
-        index, offset = struct.unpack('!II', message[:8])
-        self.downloaded += len(message[8:])
-        if index in self.piece_buffer:
-            self.piece_buffer[index]['data'][offset] = message[8:]
-        else:
-            return
-        if len(self.piece_buffer[index]['data']) == self.piece_buffer[index]['blocks_amount']:
-            blocks = OrderedDict(sorted(self.piece_buffer[index]['data'].items()))
-            self.completed_pieces[index] = b''.join(blocks.values())
-            self.requests -= len(self.completed_pieces[index])/MAX_REQUEST
-            del self.piece_buffer[index]
+        index, offset = BLOCK_HEADER.unpack_from(message)
+        data = message[BLOCK_HEADER.size:]
+        self.downloaded += len(data)
+        self.last_block = time.time()
+        self.snubbed = False
+        self.stalled = False
+        with self.lock:
+            request = self.outstanding.get((index, offset))
+            placed = request is not None and request[2] is not None and \
+                     len(request[2]) == len(data)
+            if placed:
+                request[2][:] = data
+                data = request[2]
+            else:
+                data = bytes(data)
+            self.received.append((index, offset, data, time.time(), placed))
 
-    def get_completed_pieces(self):
+    def take_blocks(self):
         '''
-        Return dictionary containing fully downloaded pieces.
+        Return list of received blocks (index, offset, data, arrival time,
+        whether data is already in its destination).
         '''
-        if self.completed_pieces:
-            temp = self.completed_pieces
-            self.completed_pieces = {}
-            return temp
-        return None
+        with self.lock:
+            blocks = self.received
+            self.received = []
+        return blocks
+
+    def update_rtt(self, sample):
+        '''
+        Update round-trip time with time between request and arrival of block.
+        The minimal one is kept, because later requests queue behind earlier.
+        '''
+        self.rtt = min(self.rtt, sample) if self.rtt else sample
 
     def fill_bitfield(self, bitfield):
         '''
-        Fill bitfield dictionary with bools indicating whether this peer
-        has the piece with key index.
+        Store bitfield received from peer. Pieces are counted in swarm availability.
+        '''
+        if self.swarm is not None:
+            self.swarm.remove_bitfield(self.bitfield)
+        self.bitfield = bytearray(bitfield)
+        if self.swarm is not None and self.alive:
+            self.swarm.add_bitfield(self.bitfield)
+
+    def add_piece(self, index):
+        '''
+        Mark piece as available from this peer (have message). Indexes
+        of pieces that torrent doesn't have are ignored.
         '''
-        for i, byte in enumerate(bitfield):
-            for j, bit in enumerate(('0'*8+bin(byte)[2:])[-8:]):
-                self.bitfield[i*8+j] = bit
+        if self.swarm is not None and index >= self.swarm.count:
+            return
+        if index >= len(self.bitfield)*8:
+            self.bitfield += bytes(index//8 + 1 - len(self.bitfield))
+        if not get_bit(self.bitfield, index):
+            set_bit(self.bitfield, index)
+            if self.swarm is not None and self.alive:
+                self.swarm.add_piece(index)
 
-    def send_request(self, pieces):
+    def request_block(self, index, offset, length, dest=None):
         '''
-        Request pieces divided to 2^14 bytes blocks.
-        The number of simultaneously pending requests is calculated
-        based on peer's transmission speed.
+        Request block of piece and remember when it was requested. Block
+        will be copied into dest (a memoryview) when it arrives. If peer
+        had nothing to send, snub timer starts from now. It isn't restarted
+        if requests were cancelled because peer didn't send them in time.
         '''
         if self.timer == 0:
             self.timer = time.time()
-        to_write = bytearray()
-        for piece_index, piece_size in pieces.items():
-            self.piece_buffer[piece_index] = {'index': piece_index, 'size': piece_size,
-                                              'data': {}, 'blocks_amount': 0}
-            last_block_size = piece_size % MAX_REQUEST
-            for offset in range(0, piece_size - last_block_size, MAX_REQUEST):
-                self.piece_buffer[piece_index]['blocks_amount'] += 1
-                to_write += construct_message('request', piece_index, offset, MAX_REQUEST)
-            if last_block_size:
-                self.piece_buffer[piece_index]['blocks_amount'] += 1
-                to_write += construct_message('request', piece_index,
-                                              piece_size - last_block_size, last_block_size)
+        if not self.outstanding and not self.stalled:
+            self.last_block = time.time()
         with self.lock:
-            self.write_buffer += to_write
+            self.outstanding[(index, offset)] = (length, time.time(), dest)
+        self.push(REQUEST.pack(13, 6, index, offset, length))
 
-    def send_cancel(self, piece_index, piece_size):
+    def cancel_block(self, index, offset, length):
         '''
-        Cancel the request(only used in endgame).
+        Cancel the request of block.
         '''
-        last_block_size = piece_size % MAX_REQUEST
-        for offset in range(0, piece_size - last_block_size, MAX_REQUEST):
-            with self.lock:
-                self.write_buffer += construct_message(
-                    'cancel', piece_index, offset, MAX_REQUEST
-                )
-        if last_block_size:
-            with self.lock:
-                self.write_buffer += construct_message(
-                    'cancel', piece_index, piece_size - last_block_size, last_block_size
-                )
+        self.forget_block(index, offset)
+        self.push(REQUEST.pack(13, 8, index, offset, length))
+
+    def forget_block(self, index, offset):
+        '''
+        Stop waiting for block. After this it is never copied to its destination.
+        '''
+        with self.lock:
+            self.outstanding.pop((index, offset), None)
 
     def can_request(self):
         '''
-        Check if peer is ready to accept the request.
+        Check if peer is ready to accept the request. Snubbed peers get
+        only one request at a time until they send something.
         '''
-        return self.unchoked and self.requests < self.max_requests
+        if self.snubbed:
+            return self.unchoked and not self.outstanding
+        return self.unchoked and len(self.outstanding) < self.window
 
     def has_piece(self, index):
         '''
         Check if peer has piece with given index.
         '''
-        try:
-            return self.bitfield[index]
-        except KeyError:
-            return False
+        return index < len(self.bitfield)*8 and get_bit(self.bitfield, index)
@@ -0,0 +1,115 @@
+'''
+Piece pickers decide which pieces should be requested from a peer.
+'''
+
+import random
+from array import array
+from itertools import chain
+from core.pieces import Availability, iter_bits, set_bit
+
+MAX_PROBES = 32
+
+class RarestFirstPicker(Availability):
+    '''
+    Availability that also keeps pieces that can be requested in buckets
+    by number of peers having them. Pieces are picked from the rarest
+    bucket first, starting from random position in it, so peers don't
+    fight over the same pieces. Pieces that can be picked are also kept
+    in a bitfield, so pieces of a peer are found without walking buckets.
+    '''
+    def __init__(self, count):
+        super().__init__(count)
+        self.buckets = [[]]
+        self.positions = array('i', [-1]) * count
+        self.pickable = bytearray((count + 7) // 8)
+
+    def update(self, index, delta):
+        '''
+        Change availability of piece and move it to another bucket.
+        '''
+        position = self.positions[index]
+        if position != -1:
+            self.take(index, position)
+        self.counts[index] += delta
+        if position != -1:
+            self.put(index)
+
+    def put(self, index):
+        '''
+        Put piece to the end of bucket it belongs to. Called with lock held.
+        '''
+        count = self.counts[index]
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        self.positions[index] = len(self.buckets[count])
+        self.buckets[count].append(index)
+        set_bit(self.pickable, index)
+
+    def take(self, index, position):
+        '''
+        Remove piece from its bucket by moving the last piece of bucket
+        to its place. Called with lock held.
+        '''
+        bucket = self.buckets[self.counts[index]]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self.positions[last] = position
+        self.positions[index] = -1
+        set_bit(self.pickable, index, False)
+
+    def add(self, index):
+        '''
+        Make piece available for picking (e.g. its data was corrupted).
+        '''
+        with self.lock:
+            if self.positions[index] == -1:
+                self.put(index)
+
+    def remove(self, index):
+        '''
+        Stop picking piece (e.g. it has been downloaded).
+        '''
+        with self.lock:
+            if self.positions[index] != -1:
+                self.take(index, self.positions[index])
+
+    def pick(self, peer, amount):
+        '''
+        Return a list of at most amount pieces that peer has. Returned
+        pieces are removed from the picker until they are added again.
+        Peer's bitfield is intersected with pickable pieces first, then
+        at most MAX_PROBES pieces of each bucket are tried. If that finds
+        too few pieces, the rest are taken from the intersection.
+        '''
+        picked = []
+        with self.lock:
+            size = len(self.pickable)
+            mask = int.from_bytes(self.pickable, 'big') & \
+                   int.from_bytes(bytes(peer.bitfield[:size]).ljust(size, b'\x00'), 'big')
+            if not mask:
+                return picked
+            for bucket in self.buckets[1:]:
+                if len(picked) >= amount:
+                    break
+                if not bucket:
+                    continue
+                start = random.randrange(len(bucket))
+                for position in range(min(len(bucket), MAX_PROBES)):
+                    index = bucket[(start + position) % len(bucket)]
+                    if peer.has_piece(index) and index not in picked:
+                        picked.append(index)
+                        if len(picked) >= amount:
+                            break
+            if len(picked) < amount:
+                bits = mask.to_bytes(size, 'big')
+                start = random.randrange(size)
+                for index in chain((start*8 + x for x in iter_bits(bits[start:])),
+                                   iter_bits(bits[:start])):
+                    if len(picked) >= amount:
+                        break
+                    if index not in picked:
+                        picked.append(index)
+            for index in picked:
+                self.take(index, self.positions[index])
+        return picked
@@ -0,0 +1,165 @@
+'''
+A compact table containing state of all pieces of a torrent.
+'''
+
+import re
+import threading
+from array import array
+from hashlib import sha1
+
+SHA_LEN = 20
+NONZERO = re.compile(b'[^\x00]')
+BITS = [tuple(j for j in range(8) if byte & (0x80 >> j)) for byte in range(256)]
+
+def get_bit(bitfield, index):
+    '''
+    Check if bit with given index is set. Bit 7 of byte 0 is index 0, just
+    like in bitfield message.
+    '''
+    return bool(bitfield[index >> 3] & (0x80 >> (index & 7)))
+
+def set_bit(bitfield, index, value=True):
+    '''
+    Set or clear bit with given index.
+    '''
+    if value:
+        bitfield[index >> 3] |= 0x80 >> (index & 7)
+    else:
+        bitfield[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+def iter_bits(bitfield):
+    '''
+    Yield indexes of all set bits. Zero bytes are skipped by regex engine,
+    so sparse bitfields are walked quickly.
+    '''
+    for match in NONZERO.finditer(bitfield):
+        pos = match.start()
+        for bit in BITS[bitfield[pos]]:
+            yield pos*8 + bit
+
+class PieceTable(object):
+    '''
+    State of all pieces. Hashes are stored in one contiguous buffer,
+    have/needed flags are packed into bitfields and sizes and request
+    times (0 if piece isn't requested) are typed arrays.
+    '''
+    def __init__(self, hashes, piece_length, length):
+        self.hashes = memoryview(hashes)
+        self.count = len(hashes) // SHA_LEN
+        self.piece_length = piece_length
+        self.sizes = array('I', [piece_length]) * self.count
+        if self.count:
+            self.sizes[-1] = length - (self.count-1)*piece_length
+        self.have = bytearray((self.count+7) // 8)
+        self.needed = bytearray(len(self.have))
+        self.requested = array('d', bytes(8*self.count))
+
+    def __len__(self):
+        return self.count
+
+    def hash(self, index):
+        '''
+        Return SHA1 hash of piece with given index.
+        '''
+        return self.hashes[index*SHA_LEN:(index+1)*SHA_LEN]
+
+    def size(self, index):
+        '''
+        Return size of piece with given index.
+        '''
+        return self.sizes[index]
+
+    def offset(self, index):
+        '''
+        Return position of piece with given index within the torrent.
+        '''
+        return index * self.piece_length
+
+    def has(self, index):
+        '''
+        Check if we have piece with given index.
+        '''
+        return get_bit(self.have, index)
+
+    def set_have(self, index, value=True):
+        '''
+        Mark piece as downloaded or not.
+        '''
+        set_bit(self.have, index, value)
+
+    def is_needed(self, index):
+        '''
+        Check if piece with given index belongs to files that are being downloaded.
+        '''
+        return get_bit(self.needed, index)
+
+    def set_needed(self, index, value=True):
+        '''
+        Mark piece as needed or not.
+        '''
+        set_bit(self.needed, index, value)
+
+    def validate(self, index, data):
+        '''
+        Check if given data has correct hash-sum.
+        '''
+        return self.hash(index) == sha1(data).digest()
+
+    def completed(self):
+        '''
+        Return a list of indexes of pieces that are needed and downloaded.
+        '''
+        size = len(self.have)
+        result = int.from_bytes(self.needed, 'big') & int.from_bytes(self.have, 'big')
+        return list(iter_bits(result.to_bytes(size, 'big')))
+
+    def missing(self, bitfield=None):
+        '''
+        Return a list of indexes of pieces that are needed but not downloaded.
+        If bitfield is given (e.g. peer's one), only pieces that are set in
+        it are returned. All checks are done at once on whole bitfields.
+        '''
+        size = len(self.have)
+        result = int.from_bytes(self.needed, 'big') & ~int.from_bytes(self.have, 'big')
+        if bitfield is not None:
+            result &= int.from_bytes(bytes(bitfield[:size]).ljust(size, b'\x00'), 'big')
+        return list(iter_bits(result.to_bytes(size, 'big')))
+
+class Availability(object):
+    '''
+    Number of connected peers that have each piece. Peers update it when
+    they receive bitfield or have messages and when they disconnect.
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.counts = array('H', bytes(2*count))
+        self.lock = threading.Lock()
+
+    def add_bitfield(self, bitfield, delta=1):
+        '''
+        Count all pieces set in bitfield (or uncount them if delta is -1).
+        '''
+        with self.lock:
+            for index in iter_bits(bitfield):
+                if index < self.count:
+                    self.update(index, delta)
+
+    def remove_bitfield(self, bitfield):
+        '''
+        Uncount pieces of disconnected peer.
+        '''
+        self.add_bitfield(bitfield, -1)
+
+    def add_piece(self, index):
+        '''
+        Count piece announced by have message.
+        '''
+        with self.lock:
+            if index < self.count:
+                self.update(index, 1)
+
+    def update(self, index, delta):
+        '''
+        Change availability of piece. Called with lock held.
+        '''
+        self.counts[index] += delta
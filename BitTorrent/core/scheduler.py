@@ -0,0 +1,290 @@
+'''
+Block-level request scheduler. Pieces are downloaded by 16 KB blocks
+that may come from different peers.
+'''
+
+import math
+import time
+from hashlib import sha1
+from threading import Lock
+from core.config import MAX_REQUEST, SNUB_TIME, MEMORY_BUDGET
+
+MIN_WINDOW = 4
+MAX_WINDOW = 256
+BLOCK_TIMEOUT = 5
+RATE_INTERVAL = 1
+REFILL_INTERVAL = 0.5
+FREE, REQUESTED, RECEIVED = 0, 1, 2
+
+class MemoryBudget(object):
+    '''
+    Bytes of piece buffers that may be in memory at once. Buffer is taken
+    when piece is activated and given back when piece is written to disk
+    or thrown away. One budget can be shared by schedulers of all torrents.
+    '''
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.lock = Lock()
+
+    def can_take(self, size):
+        '''
+        Check if buffer of given size fits into budget. Buffer always fits
+        when nothing is used, so pieces larger than budget can be downloaded.
+        '''
+        return not self.used or self.used + size <= self.limit
+
+    def take(self, size):
+        '''
+        Count buffer of given size as used.
+        '''
+        with self.lock:
+            self.used += size
+
+    def give(self, size):
+        '''
+        Give buffer of given size back.
+        '''
+        with self.lock:
+            self.used -= size
+
+class BlockScheduler(object):
+    '''
+    Keeps pieces that are being downloaded and decides which blocks are
+    requested from which peer. Each peer has a window of outstanding
+    requests sized by its bandwidth-delay product. Blocks that were not
+    received in time are given to other peers. Pieces are hashed while
+    they are downloaded, by hash_pool if it is given. New pieces are
+    started only if their buffers fit into memory budget.
+    '''
+    def __init__(self, pieces, picker, hash_pool=None, budget=None):
+        self.pieces = pieces
+        self.picker = picker
+        self.hash_pool = hash_pool
+        self.budget = budget if budget is not None else MemoryBudget()
+        self.active = {}
+        self.verifying = {}
+        self.completed = {}
+
+    def activate(self, index):
+        '''
+        Start downloading piece. Its data is collected in one preallocated
+        buffer, peers copy received blocks straight into it. Blocks received
+        in order are fed to running SHA1 of piece.
+        '''
+        size = self.pieces.size(index)
+        self.budget.take(size)
+        data = bytearray(size)
+        self.pieces.requested[index] = time.time()
+        self.active[index] = {
+            'data': data, 'view': memoryview(data),
+            'state': bytearray(math.ceil(size/MAX_REQUEST)), 'received': 0, 'peers': {},
+            'sha': sha1(), 'hashed': 0, 'hashing': None
+        }
+
+    def block_length(self, index, offset):
+        '''
+        Return length of block of piece with given index starting from offset.
+        '''
+        return min(MAX_REQUEST, self.pieces.size(index) - offset)
+
+    def next_block(self, peer, endgame):
+        '''
+        Return (index, offset) of block that should be requested from peer
+        or None. Free blocks of active pieces are requested before new pieces
+        are picked, if memory budget allows it. In endgame mode blocks
+        requested from other peers are requested again.
+        '''
+        for index, piece in self.active.items():
+            if peer.has_piece(index):
+                block = piece['state'].find(FREE)
+                if block != -1:
+                    return index, block*MAX_REQUEST
+        picked = []
+        if self.budget.can_take(self.pieces.piece_length):
+            picked = self.picker.pick(peer, 1)
+        if picked:
+            self.activate(picked[0])
+            return picked[0], 0
+        if endgame:
+            for index, piece in self.active.items():
+                if not peer.has_piece(index):
+                    continue
+                for offset, peers in piece['peers'].items():
+                    if peer not in peers:
+                        return index, offset
+        return None
+
+    def fill(self, peer, endgame):
+        '''
+        Request blocks from peer until its window is full.
+        '''
+        while peer.can_request():
+            block = self.next_block(peer, endgame)
+            if block is None:
+                return
+            index, offset = block
+            piece = self.active[index]
+            piece['state'][offset//MAX_REQUEST] = REQUESTED
+            piece['peers'].setdefault(offset, []).append(peer)
+            length = self.block_length(index, offset)
+            peer.request_block(index, offset, length, piece['view'][offset:offset+length])
+
+    def free(self, peer, index, offset):
+        '''
+        Forget that block was requested from peer. If nobody else has
+        requested it, it can be requested again.
+        '''
+        peer.forget_block(index, offset)
+        piece = self.active.get(index)
+        if piece is None or offset not in piece['peers']:
+            return
+        peers = piece['peers'][offset]
+        if peer in peers:
+            peers.remove(peer)
+        if not peers:
+            del piece['peers'][offset]
+            if piece['state'][offset//MAX_REQUEST] == REQUESTED:
+                piece['state'][offset//MAX_REQUEST] = FREE
+
+    def collect(self, peer, now):
+        '''
+        Copy blocks received by peer into their pieces and update peer's
+        throughput, round-trip time and window.
+        '''
+        self.store(peer)
+        self.update_window(peer, now)
+
+    def store(self, peer):
+        '''
+        Copy blocks received by peer into their pieces. Other peers that
+        were asked for the same blocks get cancel messages.
+        '''
+        for index, offset, data, arrived, placed in peer.take_blocks():
+            request = peer.outstanding.get((index, offset))
+            if request is not None:
+                peer.update_rtt(arrived - request[1])
+            piece = self.active.get(index)
+            if piece is None or offset % MAX_REQUEST or offset >= len(piece['data']) or \
+               len(data) != self.block_length(index, offset) or \
+               piece['state'][offset//MAX_REQUEST] == RECEIVED:
+                self.free(peer, index, offset)
+                continue
+            if not placed:
+                piece['data'][offset:offset+len(data)] = data
+            piece['state'][offset//MAX_REQUEST] = RECEIVED
+            piece['received'] += 1
+            for other in piece['peers'].pop(offset, []):
+                other.forget_block(index, offset)
+                if other is not peer:
+                    other.cancel_block(index, offset, len(data))
+            self.hash_blocks(piece)
+            if piece['received'] == len(piece['state']):
+                self.verifying[index] = piece
+                self.pieces.requested[index] = 0
+                del self.active[index]
+
+    def hash_blocks(self, piece):
+        '''
+        Feed blocks received in order since the last call to running SHA1
+        of piece. Only one update of a piece is given to hash pool at once,
+        so blocks are hashed in order.
+        '''
+        if piece['hashing'] is not None and not piece['hashing'].done():
+            return
+        start = end = piece['hashed']
+        while end < len(piece['data']) and piece['state'][end//MAX_REQUEST] == RECEIVED:
+            end = min(end + MAX_REQUEST, len(piece['data']))
+        if end == start:
+            return
+        piece['hashed'] = end
+        if self.hash_pool is None:
+            piece['sha'].update(piece['view'][start:end])
+        else:
+            piece['hashing'] = self.hash_pool.submit(piece['sha'].update, piece['view'][start:end])
+
+    def verify(self, wait=False):
+        '''
+        Check hash-sums of downloaded pieces which hashing has finished.
+        Correct pieces are completed, the rest are given back to picker.
+        If wait is set, wait until all downloaded pieces are hashed.
+        '''
+        for index, piece in list(self.verifying.items()):
+            if wait and piece['hashing'] is not None:
+                piece['hashing'].result()
+            self.hash_blocks(piece)
+            if wait and piece['hashing'] is not None:
+                piece['hashing'].result()
+            if piece['hashed'] < len(piece['data']) or \
+               piece['hashing'] is not None and not piece['hashing'].done():
+                continue
+            del self.verifying[index]
+            if piece['sha'].digest() == self.pieces.hash(index):
+                self.completed[index] = piece['data']
+            else:
+                self.budget.give(len(piece['data']))
+                self.picker.add(index)
+
+    @staticmethod
+    def update_window(peer, now):
+        '''
+        Measure peer's throughput once in RATE_INTERVAL seconds and set its
+        window to twice the amount of blocks it sends in round-trip time plus
+        REFILL_INTERVAL (windows are refilled only that often), plus some
+        spare requests. Doubling lets window grow while it limits the rate.
+        '''
+        if now - peer.rate_time < RATE_INTERVAL:
+            return
+        sample = (peer.downloaded - peer.rate_bytes) / (now - peer.rate_time)
+        peer.rate = 0.7*peer.rate + 0.3*sample if peer.rate else sample
+        peer.rate_time, peer.rate_bytes = now, peer.downloaded
+        if peer.rtt and not peer.frozen:
+            blocks = 2*peer.rate*(peer.rtt + REFILL_INTERVAL)/MAX_REQUEST
+            peer.window = min(MAX_WINDOW, math.ceil(blocks) + MIN_WINDOW)
+
+    def cancel(self, peer, blocks):
+        '''
+        Cancel requests of given blocks and let other peers request them.
+        '''
+        for index, offset in blocks:
+            peer.cancel_block(index, offset, peer.outstanding[(index, offset)][0])
+            self.free(peer, index, offset)
+
+    def check_timeouts(self, peers, now):
+        '''
+        Give blocks that peers haven't sent in time to other peers. Peers
+        that haven't sent any block for SNUB_TIME seconds are snubbed and
+        lose all their requests at once. Peers which requests timed out are
+        marked stalled, so their snub timer keeps running.
+        '''
+        for peer in peers:
+            if peer.outstanding and now - peer.last_block > SNUB_TIME:
+                peer.snubbed = True
+                peer.window = MIN_WINDOW
+                self.cancel(peer, list(peer.outstanding))
+                continue
+            timeout = max(BLOCK_TIMEOUT, 4*peer.rtt)
+            stalled = [key for key, request in peer.outstanding.items()
+                       if now - request[1] > timeout]
+            self.cancel(peer, stalled)
+            if stalled:
+                peer.stalled = True
+                peer.window = max(MIN_WINDOW, peer.window // 2)
+
+    def release_peer(self, peer):
+        '''
+        Take blocks that disconnected peer has sent and free the ones it hasn't.
+        '''
+        self.store(peer)
+        for index, offset in list(peer.outstanding):
+            self.free(peer, index, offset)
+
+    def take_completed(self, wait=False):
+        '''
+        Return dictionary containing downloaded pieces with correct hash-sums.
+        If wait is set, pieces that are being hashed are waited for.
+        '''
+        self.verify(wait)
+        completed = self.completed
+        self.completed = {}
+        return completed
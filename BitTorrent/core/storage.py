@@ -0,0 +1,465 @@
+'''
+Classes that read and write torrent data on disk.
+'''
+
+import os
+import mmap
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from core.config import MAX_OPEN_FILES, WRITE_QUEUE_SIZE, FSYNC_INTERVAL
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+WRITE_BATCH = 16*1024*1024
+
+def split_buffers(buffers, length):
+    '''
+    Take buffers (memoryviews) covering length bytes from the front of deque.
+    Buffer that is only partly covered is split without copying.
+    '''
+    parts = []
+    while length and buffers:
+        if len(buffers[0]) <= length:
+            part = buffers.popleft()
+        else:
+            part = buffers[0][:length]
+            buffers[0] = buffers[0][length:]
+        parts.append(part)
+        length -= len(part)
+    return parts
+
+def merge_maps(piece_maps):
+    '''
+    Join piece maps of adjacent pieces into one. Segments that continue each
+    other in the same file are merged, so they are written with one call.
+    '''
+    merged = []
+    for segment in [x for piece_map in piece_maps for x in piece_map]:
+        if merged and merged[-1]['file'] is segment['file'] and \
+           merged[-1]['needed'] == segment['needed'] and \
+           merged[-1]['offset'] + merged[-1]['length'] == segment['offset']:
+            merged[-1] = dict(merged[-1], length=merged[-1]['length']+segment['length'])
+        else:
+            merged.append(segment)
+    return merged
+
+def write_all(fd, buffers, offset):
+    '''
+    Write all buffers to fd starting from offset with as few pwritev calls as possible.
+    '''
+    buffers = deque(buffers)
+    while buffers:
+        written = os.pwritev(fd, list(buffers)[:IOV_MAX], offset)
+        offset += written
+        split_buffers(buffers, written)
+
+class FileSpan(object):
+    '''
+    Part of a file that is sent to socket with sendfile instead of being
+    read into memory. Spans can be sliced like memoryviews, so they are
+    queued and split together with them.
+    '''
+    def __init__(self, storage, path, offset, length):
+        self.storage = storage
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.length)
+        return FileSpan(self.storage, self.path, self.offset+start, max(0, stop-start))
+
+    def send(self, sock_fd):
+        '''
+        Send span to socket. Return number of bytes sent.
+        '''
+        return self.storage.sendfile(sock_fd, self.path, self.offset, self.length)
+
+class Storage(object):
+    '''
+    Reads and writes pieces with positional I/O. Open descriptors are kept
+    in a pool of bounded size, the least recently used one is closed first.
+    Descriptors can be used from several threads at the same time.
+    '''
+    def __init__(self, max_files=MAX_OPEN_FILES):
+        self.max_files = max_files
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def handle(self, path, create=False):
+        '''
+        Yield open descriptor of file with given path or None if there is no
+        such file and create is False. Files are opened read-only unless
+        create is set (they are written), so read-only files can be seeded.
+        Read-only descriptor is reopened for writing when it is needed.
+        '''
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is not None and create and not handle[2]:
+                del self.handles[path]
+                if handle[1] == 0:
+                    os.close(handle[0])
+                handle = None
+            if handle is not None:
+                self.handles.move_to_end(path)
+            elif create or os.path.exists(path):
+                if create:
+                    handle = [os.open(path, os.O_RDWR | os.O_CREAT), 0, True]
+                else:
+                    handle = [os.open(path, os.O_RDONLY), 0, False]
+                self.handles[path] = handle
+                self.evict()
+            if handle is not None:
+                handle[1] += 1
+        if handle is None:
+            yield None
+            return
+        try:
+            yield handle[0]
+        finally:
+            with self.lock:
+                handle[1] -= 1
+                if handle[1] == 0 and self.handles.get(path) is not handle:
+                    os.close(handle[0])
+
+    def evict(self):
+        '''
+        Close least recently used descriptors if there are too many of them.
+        Descriptors that are in use are closed when they are released.
+        '''
+        while len(self.handles) > self.max_files:
+            path, handle = self.handles.popitem(last=False)
+            if handle[1] == 0:
+                os.close(handle[0])
+
+    def allocate(self, files):
+        '''
+        Prepare files for writing. Files grow as pieces are written, so
+        there is nothing to do.
+        '''
+        pass
+
+    def flush(self):
+        '''
+        Data is written with pwrite, so there is nothing to flush.
+        '''
+        pass
+
+    def read(self, piece_map):
+        '''
+        Read data described by piece map (see Torrent.map_range).
+        If some file is missing or too short, data up to that point is returned.
+        '''
+        result = bytearray(sum(x['length'] for x in piece_map))
+        view = memoryview(result)
+        position = 0
+        for segment in piece_map:
+            with self.handle(segment['file']['path']) as fd:
+                if fd is None:
+                    return result[:position]
+                target = view[position:position+segment['length']]
+                offset = segment['offset']
+                while target:
+                    got = os.preadv(fd, [target], offset)
+                    if not got:
+                        return result[:position]
+                    position += got
+                    offset += got
+                    target = target[got:]
+        return result
+
+    def write(self, piece_map, buffers):
+        '''
+        Write buffers (e.g. piece or its blocks in order) to segments of
+        piece map that are needed. Buffers that go to the same file are
+        written with one vectored call.
+        '''
+        buffers = deque(memoryview(x) for x in buffers)
+        for segment in piece_map:
+            parts = split_buffers(buffers, segment['length'])
+            if segment['needed']:
+                with self.handle(segment['file']['path'], True) as fd:
+                    write_all(fd, parts, segment['offset'])
+
+    def sync(self, paths):
+        '''
+        Flush data of files with given paths to disk.
+        '''
+        for path in paths:
+            with self.handle(path) as fd:
+                if fd is not None:
+                    os.fsync(fd)
+
+    def span(self, piece_map):
+        '''
+        Return FileSpan of data described by piece map if it lies within
+        one file and sendfile is available, otherwise None.
+        '''
+        if len(piece_map) != 1 or not hasattr(os, 'sendfile'):
+            return None
+        segment = piece_map[0]
+        return FileSpan(self, segment['file']['path'], segment['offset'], segment['length'])
+
+    def sendfile(self, sock_fd, path, offset, length):
+        '''
+        Send part of file to socket without reading it. Return number of
+        bytes sent, 0 if file is missing or too short.
+        '''
+        with self.handle(path) as fd:
+            if fd is None:
+                return 0
+            return os.sendfile(sock_fd, fd, offset, length)
+
+    def close(self):
+        '''
+        Close all open descriptors.
+        '''
+        with self.lock:
+            while self.handles:
+                path, handle = self.handles.popitem()
+                if handle[1] == 0:
+                    os.close(handle[0])
+
+class MmapStorage(object):
+    '''
+    Keeps every file memory-mapped. Pieces are copied straight into the
+    mappings and data is read as memoryview slices of them, so page cache
+    does all the work and no read/write calls are made.
+    '''
+    def __init__(self):
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def mapping(self, file_, create=False):
+        '''
+        Return mapping of the file or None if file doesn't exist or is shorter
+        than it should be and create is False. Created files are preallocated.
+        '''
+        with self.lock:
+            mapped = self.maps.get(file_['path'])
+            if mapped is not None or not file_['length']:
+                return mapped
+            if not create and (not os.path.exists(file_['path']) or
+                               os.path.getsize(file_['path']) < file_['length']):
+                return None
+            fd = os.open(file_['path'], os.O_RDWR | os.O_CREAT)
+            try:
+                if os.fstat(fd).st_size < file_['length']:
+                    os.ftruncate(fd, file_['length'])
+                mapped = mmap.mmap(fd, file_['length'])
+            finally:
+                os.close(fd)
+            self.maps[file_['path']] = mapped
+            return mapped
+
+    def allocate(self, files):
+        '''
+        Preallocate and map all given files.
+        '''
+        for file_ in files:
+            self.mapping(file_, True)
+
+    def flush(self):
+        '''
+        Write changes made to mappings to disk.
+        '''
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.flush()
+
+    def read(self, piece_map):
+        '''
+        Return data described by piece map. Piece that lies within one file is
+        returned as memoryview of mapping without copying.
+        If some file is missing or too short, data up to that point is returned.
+        '''
+        parts = []
+        for segment in piece_map:
+            mapped = self.mapping(segment['file'])
+            if mapped is None:
+                break
+            parts.append(memoryview(mapped)[segment['offset']:segment['offset']+segment['length']])
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def sync(self, paths):
+        '''
+        Flush mappings of files with given paths to disk.
+        '''
+        with self.lock:
+            for path in paths:
+                if path in self.maps:
+                    self.maps[path].flush()
+
+    def span(self, piece_map):
+        '''
+        Data is read from mappings without copying, so spans aren't used.
+        '''
+        return None
+
+    def write(self, piece_map, buffers):
+        '''
+        Copy buffers to segments of piece map that are needed.
+        '''
+        buffers = deque(memoryview(x) for x in buffers)
+        for segment in piece_map:
+            parts = split_buffers(buffers, segment['length'])
+            if segment['needed']:
+                mapped = self.mapping(segment['file'], True)
+                offset = segment['offset']
+                for part in parts:
+                    mapped[offset:offset+len(part)] = part
+                    offset += len(part)
+
+    def close(self):
+        '''
+        Flush and close all mappings. Mappings that are still exported
+        as memoryviews will be closed by garbage collector.
+        '''
+        with self.lock:
+            while self.maps:
+                mapped = self.maps.popitem()[1]
+                mapped.flush()
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+
+class DiskWriter(object):
+    '''
+    Writes pieces to storage in a background thread. Pieces are queued
+    with put() and written in batches: adjacent pieces are merged into
+    larger writes. Written files are fsynced every FSYNC_INTERVAL seconds
+    (after every batch if it is 0, never if it is negative). Queue is
+    bounded by size of queued pieces: when it is full, downloader should
+    stop requesting new pieces.
+    '''
+    def __init__(self, storage, max_size=WRITE_QUEUE_SIZE, fsync_interval=FSYNC_INTERVAL):
+        self.storage = storage
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.queue = deque()
+        self.size = 0
+        self.done = []
+        self.dirty = set()
+        self.sync_time = time.time()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.alive = True
+
+    def put(self, index, piece_map, data):
+        '''
+        Queue piece for writing. Never blocks, check full() before
+        requesting more pieces.
+        '''
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+            self.queue.append((index, piece_map, data))
+            self.size += len(data)
+            self.condition.notify()
+
+    def full(self):
+        '''
+        Check if queued pieces take more memory than allowed.
+        '''
+        return self.size >= self.max_size
+
+    def depth(self):
+        '''
+        Return number of pieces waiting to be written.
+        '''
+        return len(self.queue)
+
+    def take_done(self):
+        '''
+        Return list of (index, error) of pieces that were written (error
+        is None) or failed to be written since the last call.
+        '''
+        with self.condition:
+            done = self.done
+            self.done = []
+        return done
+
+    def batch(self):
+        '''
+        Take queued pieces up to WRITE_BATCH bytes. Called with lock held.
+        '''
+        pieces = []
+        size = 0
+        while self.queue and size < WRITE_BATCH:
+            pieces.append(self.queue.popleft())
+            size += len(pieces[-1][2])
+        return pieces
+
+    def loop(self):
+        '''
+        Write queued pieces until writer is closed and queue is empty.
+        '''
+        while True:
+            with self.condition:
+                while not self.queue and self.alive:
+                    self.condition.wait(max(self.fsync_interval, 1))
+                    if self.dirty and self.fsync_interval >= 0 and \
+                       time.time() - self.sync_time >= self.fsync_interval:
+                        break
+                pieces = self.batch()
+                if not pieces and not self.alive:
+                    break
+            done = self.write(pieces)
+            if self.dirty and self.fsync_interval >= 0 and \
+               time.time() - self.sync_time >= self.fsync_interval:
+                self.sync()
+            with self.condition:
+                self.size -= sum(len(x[2]) for x in pieces)
+                self.done += done
+        if self.dirty and self.fsync_interval >= 0:
+            self.sync()
+
+    def write(self, pieces):
+        '''
+        Write pieces, merging runs of adjacent ones. Return list of (index, error).
+        '''
+        done = []
+        run = []
+        for piece in sorted(pieces, key=lambda x: x[0]) + [None]:
+            if run and (piece is None or piece[0] != run[-1][0] + 1):
+                try:
+                    self.storage.write(merge_maps([x[1] for x in run]), [x[2] for x in run])
+                    error = None
+                except OSError as exc:
+                    error = exc
+                self.dirty.update(x['file']['path'] for y in run for x in y[1] if x['needed'])
+                done += [(x[0], error) for x in run]
+                run = []
+            if piece is not None:
+                run.append(piece)
+        return done
+
+    def sync(self):
+        '''
+        Fsync files that were written since the last sync.
+        '''
+        dirty, self.dirty = self.dirty, set()
+        try:
+            self.storage.sync(dirty)
+        except OSError:
+            pass
+        self.sync_time = time.time()
+
+    def close(self):
+        '''
+        Write all queued pieces and stop thread.
+        '''
+        with self.condition:
+            self.alive = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
@@ -5,26 +5,23 @@ A class to work with torrents.
 import time
 import os
 import sys
+from bisect import bisect_right
 from hashlib import sha1
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from core.tracker import Tracker
-from core.becnode import benencode
+from core.becnode import benencode, bendecode, bendump
 from core.network import Peer, Server, SocketHandler
-from core.config import ENDGAME_PERCENT, MAX_PEERS, UPLOAD_PEERS, PEER_ID, KEY
+from core.pieces import PieceTable, get_bit
+from core.picker import RarestFirstPicker
+from core.scheduler import BlockScheduler, MemoryBudget, REFILL_INTERVAL
+from core.storage import Storage, MmapStorage, DiskWriter
+from core.cache import PieceCache
+from core.config import ENDGAME_PERCENT, MAX_PEERS, UPLOAD_PEERS, PEER_ID, KEY, \
+                        HASH_THREADS, RESUME_INTERVAL
 
-SHA_LEN = 20
 SPEED_DELTA = 100
-
-def read_file_with_offset(file_, offset, length):
-    '''
-    Read length bytes from position offset from given file.
-    '''
-    if not os.path.exists(file_['path']):
-        return b''
-    with open(file_['path'], 'rb') as fiel:
-        fiel.seek(offset, 0)
-        data = fiel.read(length)
-    return data
+CHECK_READ_SIZE = 16*1024*1024
 
 class Torrent(object):
     '''
@@ -32,30 +29,48 @@ class Torrent(object):
     This class contains some torrenting-related methods and variables.
     '''
     torrents_count = 0
+    picker_class = RarestFirstPicker
+    server_class = Server
+    use_sendfile = True
+    cache = PieceCache()
+    hash_pool = ThreadPoolExecutor(HASH_THREADS)
+    budget = MemoryBudget()
 
-    def __init__(self, speed_limit, upload_limit):
+    def __init__(self, speed_limit, upload_limit, use_mmap=False):
         self.files, self.length = [], 0
+        self.file_starts = []
         self.piece_length = 0
-        self.pieces = {}
+        self.pieces = PieceTable(b'', 0, 0)
+        self.picker = self.picker_class(0)
+        self.scheduler = BlockScheduler(self.pieces, self.picker, self.hash_pool, self.budget)
         self.downloaded = 0
         self.handshake = b''
         self.trackers = []
         self.got = 0
         self.uploaded = 0
         self.server = None
+        self.storage = MmapStorage() if use_mmap else Storage()
+        self.writer = DiskWriter(self.storage)
+        self.writing = set()
+        self.completed = {}
         self.upload_peers = 0
         self.speed_limit = speed_limit
         self.upload_limit = upload_limit
         self.start_time = 0
         self.seeding = False
         self.peers, self.backup_peers = [], []
+        self.resume_path = None
+        self.resume_time = 0
 
-    def set_up(self, data, out_folder):
+    def set_up(self, data, out_folder, raw_info=None):
         '''
         Additional init that works with network.
+        Raw_info is the original bencoded info dictionary, info_hash is
+        computed over it. If it is not given, info dictionary is encoded again.
         '''
-        self.server = Server(Torrent.torrents_count)
+        self.server = self.server_class(Torrent.torrents_count)
         self.files, self.length = Torrent.get_filedata(data['info'], out_folder)
+        self.index_files()
         self.piece_length = data['info']['piece length']
         for index, file_ in enumerate(self.files):
             print(str(index+1)+'. '+file_['path'])
@@ -64,6 +79,8 @@ class Torrent(object):
         )
         to_download = input()
         self.pieces = self.get_pieces(data['info'])
+        self.picker = self.picker_class(len(self.pieces))
+        self.scheduler = BlockScheduler(self.pieces, self.picker, self.hash_pool, self.budget)
         if to_download == '0':
             for file_ in self.files:
                 file_['needed'] = True
@@ -74,12 +91,17 @@ class Torrent(object):
                     file_['needed'] = True
                 else:
                     self.length -= file_['length']
-        for index, piece in enumerate(self.pieces):
-            piece['needed'] = bool([x for x in self.map_piece(index) if x['needed']])
-        info = benencode(data['info'])
-        info_hash = sha1(info.encode("latin-1")).digest()
+        for index in range(len(self.pieces)):
+            self.pieces.set_needed(index, any(x['needed'] for x in self.map_piece(index)))
+        if raw_info is None:
+            raw_info = benencode(data['info'])
+        info_hash = sha1(raw_info).digest()
+        self.resume_path = os.path.join(out_folder, '.'+info_hash.hex()+'.resume')
         self.handshake = b'\x13'+b'BitTorrent protocol'+b'\x00'*8+info_hash+PEER_ID
         self.downloaded = self.check_existing_data()
+        for index in self.pieces.missing():
+            self.picker.add(index)
+        self.storage.allocate([x for x in self.files if x['needed']])
         payload = {
             'info_hash': info_hash, 'peer_id': PEER_ID,
             'uploaded': 0, 'downloaded': self.downloaded,
@@ -92,19 +114,10 @@ class Torrent(object):
 
     def get_pieces(self, data):
         '''
-        Return dictionary containing 20-bytes long pieces from .torrent file.
+        Return PieceTable built from 20-bytes long hashes from .torrent file.
+        Hashes buffer is not copied.
         '''
-        hashes = data['pieces'].encode('latin-1')
-        pieces = [
-            {'hash': hashes[i:i+SHA_LEN], 'have': False,
-             'requested': (False, None),
-             'size': data['piece length'],
-             'offset': int(i/SHA_LEN*data['piece length'])}
-            for i in range(0, len(hashes), SHA_LEN)
-        ]
-        over = len(pieces) * data['piece length'] - self.length
-        pieces[-1]['size'] -= over
-        return pieces
+        return PieceTable(data['pieces'], data['piece length'], self.length)
 
     @staticmethod
     def get_filedata(data, out_folder):
@@ -112,30 +125,22 @@ class Torrent(object):
         Return a dictionary containing information about files and their total length.
         '''
         files = []
+        name = str(data['name'], 'utf8')
         if 'files' in data:
             length = 0
             for file_info in data['files']:
+                path = name+'/'+'/'.join(str(part, 'utf8') for part in file_info['path'])
                 if out_folder:
-                    path = (out_folder+'/'+data['name']+'/'+
-                            '/'.join(file_info['path'])).encode('latin-1').decode('utf8')
-                else:
-                    path = (data['name']+'/'+
-                            '/'.join(file_info['path'])).encode('latin-1').decode('utf8')
+                    path = out_folder+'/'+path
                 files.append({'path': path, 'length': file_info['length']})
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 length += file_info['length']
         else:
             if out_folder:
-                files.append(
-                    {'path': out_folder+'/'+data['name'].encode('latin-1').decode('utf8'),
-                     'length': data['length']}
-                )
+                files.append({'path': out_folder+'/'+name, 'length': data['length']})
                 os.makedirs(out_folder, exist_ok=True)
             else:
-                files.append(
-                    {'path': data['name'].encode('latin-1').decode('utf8'),
-                     'length': data['length']}
-                )
+                files.append({'path': name, 'length': data['length']})
             length = data['length']
         for file_ in files:
             file_['needed'] = False
@@ -143,18 +148,11 @@ class Torrent(object):
 
     def construct_bitfield(self):
         '''
-        Construct bitfield, a bytestring indicating what pieces we have.
+        Return bitfield, a bytestring indicating what pieces we have. It is the
+        packed have-bitfield of piece table, which is updated in place when a
+        piece is inserted, so nothing is built or copied here.
         '''
-        bits = ''
-        result = bytearray()
-        for piece in self.pieces:
-            bits += str(int(piece['have']))
-            if len(bits) == 8:
-                result += bytes(chr(int(bits, 2)), encoding='latin1')
-                bits = ''
-        if bits:
-            result += bytearray(chr(int((bits+'0'*8)[:8], 2)), encoding='latin1')
-        return result
+        return memoryview(self.pieces.have)
 
     def update_peer_list(self, need_peers):
         '''
@@ -163,33 +161,55 @@ class Torrent(object):
         self.upload_peers -= len(
             [peer for peer in self.peers if not peer.is_alive() and peer.upload]
         )
+        for peer in [peer for peer in self.peers if not peer.is_alive()]:
+            self.scheduler.release_peer(peer)
         self.peers = [peer for peer in self.peers if peer.is_alive()]
         for peer in self.server.take_number_of_peers(UPLOAD_PEERS - self.upload_peers):
             self.upload_peers += 1
-            self.peers.append(Peer(self.handshake, True, peer))
+            self.peers.append(self.new_peer(True, peer))
         if not need_peers:
             return
         while self.backup_peers and len(self.peers) < MAX_PEERS:
-            self.peers.append(Peer(self.handshake))
+            self.peers.append(self.new_peer())
             self.peers[-1].connect(
                 self.backup_peers[0]['ip'],
                 self.backup_peers[0]['port']
             )
             del self.backup_peers[0]
+        self.announce()
+
+    def new_peer(self, upload=False, sock=None):
+        '''
+        Return new peer of this torrent.
+        '''
+        return Peer(self.handshake, upload, sock, self.picker)
+
+    def announce(self):
+        '''
+        Send announces to trackers that can be reannounced and connect to returned peers.
+        '''
         for tracker in [tracker for tracker in self.trackers if tracker.can_reannounce()]:
-            addresses = tracker.get_peers()
-            for ip_addr, port in addresses:
-                if len(self.peers) < MAX_PEERS:
-                    self.peers.append(Peer(self.handshake))
-                    self.peers[len(self.peers)-1].connect(ip_addr, port)
-                else:
-                    self.backup_peers.append({'ip': ip_addr, 'port': port})
+            self.add_addresses(tracker.get_peers())
+
+    def add_addresses(self, addresses):
+        '''
+        Connect to peers with given addresses. If there are too many peers
+        already, addresses are kept in backup.
+        '''
+        for ip_addr, port in addresses:
+            if len(self.peers) < MAX_PEERS:
+                self.peers.append(self.new_peer())
+                self.peers[-1].connect(ip_addr, port)
+            else:
+                self.backup_peers.append({'ip': ip_addr, 'port': port})
 
     def check_existing_data(self):
         '''
-        Check if there are any data downloaded already.
+        Check if there are any data downloaded already. Pieces that lie in
+        files that weren't changed since resume file was saved are taken
+        from it. The rest are read in large sequential chunks and hashed by
+        a pool of threads (hashlib releases GIL).
         '''
-        downloaded = 0
         no_data = True
         for file_ in [x for x in self.files if x['needed']]:
             if os.path.exists(file_['path']):
@@ -198,66 +218,145 @@ class Torrent(object):
                 open(file_['path'], 'w').close()
         if no_data:
             return 0
+        resume_bitfield, trusted = self.load_resume()
+        to_check = []
+        for index in range(len(self.pieces)):
+            if trusted and all(x['file']['path'] in trusted for x in self.map_piece(index)):
+                self.pieces.set_have(index, get_bit(resume_bitfield, index))
+            else:
+                to_check.append(index)
+        if to_check:
+            self.hash_pieces(to_check)
+        downloaded = 0
+        for index in self.pieces.completed():
+            downloaded += sum(x['length'] for x in self.map_piece(index) if x['needed'])
+        return downloaded
+
+    def hash_pieces(self, to_check):
+        '''
+        Check hash-sums of pieces with given indexes and store results in the
+        piece table. Runs of consecutive pieces are checked by thread pool.
+        '''
         print('Checking existing files...')
-        pieces_amount = len(self.pieces)
-        for index, piece in enumerate(self.pieces):
-            piece_map = self.map_piece(index)
-            data = b''.join([read_file_with_offset(x['file'], x['offset'], x['length'])
-                             for x in piece_map])
-            perc = str(round(100*(index+1)/pieces_amount, 2))
+        start_time = time.time()
+        batch = max(1, CHECK_READ_SIZE // max(1, self.pieces.piece_length))
+        batches = []
+        for index in to_check:
+            if batches and batches[-1][-1] == index-1 and len(batches[-1]) < batch:
+                batches[-1].append(index)
+            else:
+                batches.append([index])
+        checked = 0
+        total = sum(self.pieces.size(index) for index in to_check)
+        for indexes, results in zip(batches, self.hash_pool.map(self.check_pieces, batches)):
+            for index, have in zip(indexes, results):
+                self.pieces.set_have(index, have)
+                checked += self.pieces.size(index)
+            perc = str(round(100*checked/total, 2))
             sys.stdout.write('\r'+perc+' '*(5-len(perc))+'% checked.      ')
-            piece['have'] = Torrent.validate_piece(piece, data)
-            if piece['have'] and piece['needed']:
-                for piece_of_piece in [x for x in piece_map if x['needed']]:
-                    downloaded += piece_of_piece['length']
-        sys.stdout.write('\n')
-        return downloaded
+        speed = round(checked/(1024*1024*max(time.time()-start_time, 0.001)), 2)
+        sys.stdout.write('\r{} MB checked. {} MB/s.\n'.format(round(checked/(1024*1024), 2), speed))
 
-    @staticmethod
-    def validate_piece(piece, data):
+    def check_pieces(self, indexes):
         '''
-        Check if given piece has correct hash-sum.
+        Read consecutive pieces with one sequential read and return a list of
+        bools indicating whether they have correct hash-sums.
         '''
-        return piece['hash'] == sha1(data).digest()
+        start = self.pieces.offset(indexes[0])
+        length = self.pieces.offset(indexes[-1]) + self.pieces.size(indexes[-1]) - start
+        data = memoryview(self.storage.read(self.map_range(start, length)))
+        results = []
+        for index in indexes:
+            offset = self.pieces.offset(index) - start
+            results.append(self.pieces.validate(index, data[offset:offset+self.pieces.size(index)]))
+        return results
 
-    def map_piece(self, index):
+    def file_stats(self):
+        '''
+        Return a list of [size, mtime] of every file ([-1, 0] for missing ones).
+        '''
+        stats = []
+        for file_ in self.files:
+            try:
+                stat = os.stat(file_['path'])
+                stats.append([stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                stats.append([-1, 0])
+        return stats
+
+    def save_resume(self):
+        '''
+        Save bitfield of verified pieces along with sizes and modification
+        times of files, so the next start doesn't have to rehash them.
+        '''
+        if self.resume_path is None:
+            return
+        self.storage.flush()
+        resume = {'pieces': len(self.pieces), 'bitfield': bytes(self.pieces.have),
+                  'files': self.file_stats()}
+        with open(self.resume_path+'.tmp', 'wb') as resume_file:
+            bendump(resume, resume_file)
+        os.replace(self.resume_path+'.tmp', self.resume_path)
+        self.resume_time = time.time()
+
+    def load_resume(self):
+        '''
+        Return bitfield from resume file and a set of paths of files that
+        haven't changed since it was saved. If there is no valid resume file,
+        return (None, set()).
+        '''
+        try:
+            with open(self.resume_path, 'rb') as resume_file:
+                resume = bendecode(resume_file.read())
+            if resume['pieces'] != len(self.pieces) or len(resume['files']) != len(self.files) \
+               or len(resume['bitfield']) != len(self.pieces.have):
+                return None, set()
+        except (OSError, TypeError, ValueError, KeyError):
+            return None, set()
+        return resume['bitfield'], set(
+            file_['path'] for file_, stat, saved in zip(self.files, self.file_stats(), resume['files'])
+            if stat == saved
+        )
+
+    def index_files(self):
+        '''
+        Build a list of starting positions of files within the torrent,
+        so map_range can find files with binary search.
+        '''
+        self.file_starts = []
+        position = 0
+        for file_ in self.files:
+            self.file_starts.append(position)
+            position += file_['length']
+
+    def map_range(self, start, length):
         '''
         Return a list of dictionaries that looks like below:
-        [{file0, offset0, length0}, {file1, offset1, length1}, ...]
-        File - file in which given piece should be written to.
-        Offset - starting position of the piece within the file.
-        Length - length of part of given piece tha will be written in File file.
+        [{file0, offset0, length0, needed0}, {file1, offset1, length1, needed1}, ...]
+        File - file in which given range of bytes should be written to.
+        Offset - starting position of the part of range within the file.
+        Length - length of part of range that will be written in File file.
         '''
         piece_map = []
-        if len(self.files) == 1:
-            piece_map.append(
-                {'file': self.files[0], 'offset': self.pieces[index]['offset'],
-                 'length': self.pieces[index]['size'], 'needed': True}
-            )
-            return piece_map
-        start = index * self.piece_length
-        file_index = 0
-        for file_ in self.files:
-            if start - file_['length'] <= 0:
-                break
-            file_index += 1
-            start -= file_['length']
-        not_mapped = self.pieces[index]['size']
-        while True:
-            if not_mapped <= self.files[file_index]['length'] - start:
+        file_index = bisect_right(self.file_starts, start) - 1
+        while length > 0 and file_index < len(self.files):
+            file_ = self.files[file_index]
+            offset = start - self.file_starts[file_index]
+            part = min(length, file_['length'] - offset)
+            if part > 0:
                 piece_map.append(
-                    {'file': self.files[file_index], 'offset': start,
-                     'length': not_mapped, 'needed': self.files[file_index]['needed']}
+                    {'file': file_, 'offset': offset, 'length': part, 'needed': file_['needed']}
                 )
-                return piece_map
-            piece_map.append(
-                {'file': self.files[file_index], 'offset': start,
-                 'length': self.files[file_index]['length'] - start,
-                 'needed': self.files[file_index]['needed']}
-            )
-            not_mapped = not_mapped - self.files[file_index]['length'] + start
+                start += part
+                length -= part
             file_index += 1
-            start = 0
+        return piece_map
+
+    def map_piece(self, index):
+        '''
+        Return a list of file segments of piece with given index (see map_range).
+        '''
+        return self.map_range(self.pieces.offset(index), self.pieces.size(index))
 
     @staticmethod
     def get_tracker_list(data, payload):
@@ -267,55 +366,57 @@ class Torrent(object):
         trackers = []
         if 'announce-list' in data:
             for tracker in data['announce-list']:
-                trackers.append(Tracker(tracker[0], payload))
-        if data['announce'] not in [tracker.url for tracker in trackers]:
-            trackers.append(Tracker(data['announce'], payload))
+                trackers.append(Tracker(str(tracker[0], 'latin-1'), payload))
+        if 'announce' in data and \
+           str(data['announce'], 'latin-1') not in [tracker.url for tracker in trackers]:
+            trackers.append(Tracker(str(data['announce'], 'latin-1'), payload))
         return trackers
 
     def send_blocks_to_peers(self):
         '''
-        Send peers bitfields and blocks of data.
+        Send peers bitfields and blocks of data. Blocks that lie within one
+        file are sent from it with sendfile, only piece headers are built in
+        memory. Other blocks are sliced from pieces in shared piece cache.
         '''
         upspeed = self.uploaded/(1024*(time.time()-self.start_time))
-        bitfield = self.construct_bitfield()
         for peer in self.peers:
             if peer.need_bitfield:
-                peer.send_bitfield(bitfield)
-            if not (self.upload_limit != -1 or self.upload_limit - SPEED_DELTA > upspeed):
-                return
-            for index, blocks in peer.need_piece.items():
-                data = b''.join([read_file_with_offset(x['file'], x['offset'], x['length'])
-                                 for x in self.map_piece(index)])
-                for block in blocks:
+                peer.send_bitfield(self.construct_bitfield())
+            if self.upload_limit != -1 and upspeed > self.upload_limit - SPEED_DELTA:
+                continue
+            for index, blocks in list(peer.need_piece.items()):
+                if index >= len(self.pieces) or not self.pieces.has(index):
+                    continue
+                data = None
+                for block in list(blocks):
+                    if block[0] + block[1] > self.pieces.size(index):
+                        continue
+                    span = None
+                    if self.use_sendfile:
+                        span = self.storage.span(
+                            self.map_range(self.pieces.offset(index) + block[0], block[1])
+                        )
+                    if span is None:
+                        if data is None:
+                            data = memoryview(self.cache.get(self, index, self.read_piece))
+                        span = data[block[0]:block[0]+block[1]]
                     self.uploaded += block[1]
-                    peer.send_block(data[block[0]:block[0]+block[1]], index, block)
-
-    def construct_request(self, peer, endgame):
-        '''
-        Construct and send request message to peer.
-        '''
-        pieces_to_request = {}
-        for index, piece in enumerate(self.pieces):
-            if not endgame:
-                if peer.has_piece(index) and not piece['have'] and \
-                   (not piece['requested'][0] or piece['requested'][1] and \
-                    time.time()-piece['requested'][1] > 10) and \
-                   peer.can_request() and piece['needed']:
-                    piece['requested'] = (True, time.time())
-                    peer.requests += piece['size']/(2**14)
-                    pieces_to_request[index] = piece['size']
-                elif not peer.can_request():
-                    break
-            elif not peer.endgame:
-                if peer.has_piece(index) and not piece['have'] and piece['needed']:
-                    pieces_to_request[index] = piece['size']
-        peer.send_request(pieces_to_request)
-        peer.endgame = endgame
+                    peer.send_block(span, index, block)
+
+    def read_piece(self, index):
+        '''
+        Read piece with given index from disk. Return None if we don't have it.
+        '''
+        if index >= len(self.pieces) or not self.pieces.has(index):
+            return None
+        return self.storage.read(self.map_piece(index))
 
     def check_peers(self, endgame):
         '''
-        Send and receive messages to and from peers. Also this method frozes
-        peers if download speed is near the limit.
+        Collect blocks received by peers, give stalled blocks to other peers
+        and fill request windows of peers. Return completed pieces, they
+        are kept until they are inserted. Snubbed peers are filled last and nobody is filled while disk writer
+        is full. Also this method frozes peers if download speed is near the limit.
         '''
         speed = 0
         for peer in self.peers:
@@ -324,51 +425,67 @@ class Torrent(object):
             for peer in self.peers:
                 peer.frozen = True
         available_peers = [
-            peer for peer in self.peers if (peer.can_request() or endgame and peer.unchoked) and \
+            peer for peer in self.peers if peer.can_request() and \
                                            (self.speed_limit > speed or not self.speed_limit)
         ]
-        completed_pieces = []
-        for peer in available_peers:
-            self.construct_request(peer, endgame)
-            completed_pieces.append(peer.get_completed_pieces())
-        return completed_pieces
-
-    def insert_pieces(self, completed_pieces, endgame):
-        '''
-        Insert pieces into files.
-        '''
-        to_insert = {}
-        for piece_set in [x for x in completed_pieces if x]:
-            for index, piece in piece_set.items():
-                if Torrent.validate_piece(self.pieces[index], piece) and \
-                   not self.pieces[index]['have']:
-                    if endgame:
-                        for peer in self.peers:
-                            peer.send_cancel(index, self.pieces[index]['size'])
-                    self.pieces[index]['have'] = True
-                    self.pieces[index]['requested'] = (True, None)
-                    self.got += self.pieces[index]['size']
-                    to_insert[index] = piece
-                else:
-                    self.pieces[index]['requested'] = (False, None)
-        for index, piece in to_insert.items():
+        now = time.time()
+        for peer in self.peers:
+            self.scheduler.collect(peer, now)
+        self.scheduler.check_timeouts(self.peers, now)
+        if not self.writer.full():
+            for peer in sorted(available_peers, key=lambda peer: peer.snubbed):
+                self.scheduler.fill(peer, endgame)
+        self.completed.update(self.scheduler.take_completed())
+        return self.completed
+
+    def insert_pieces(self, completed_pieces):
+        '''
+        Queue pieces for writing into files. Their hash-sums have already
+        been checked by scheduler while they were downloaded. Buffers of
+        pieces that aren't needed are given back to memory budget.
+        Inserted pieces are removed from completed_pieces.
+        '''
+        for index in list(completed_pieces):
+            piece = completed_pieces.pop(index)
+            if self.pieces.has(index) or index in self.writing:
+                self.budget.give(len(piece))
+                continue
+            self.picker.remove(index)
+            self.got += self.pieces.size(index)
+            self.writing.add(index)
+            self.writer.put(index, self.map_piece(index), piece)
+
+    def finish_writes(self):
+        '''
+        Mark pieces that have been written to disk as downloaded and announce
+        them to peers. Only such pieces get into resume file. Pieces that
+        couldn't be written are downloaded again. Buffers of written pieces
+        are given back to memory budget.
+        '''
+        for index, error in self.writer.take_done():
+            self.writing.discard(index)
+            self.budget.give(self.pieces.size(index))
+            if error is not None:
+                self.got -= self.pieces.size(index)
+                self.picker.add(index)
+                continue
+            self.pieces.set_have(index)
             for peer in self.peers:
                 peer.send_have(index)
-            for filemap in self.map_piece(index):
-                if filemap['needed']:
-                    with open(filemap['file']['path'], 'rb+') as fiel:
-                        fiel.seek(filemap['offset'], 0)
-                        self.downloaded += len(piece[:filemap['length']])
-                        fiel.write(piece[:filemap['length']])
-                        piece = piece[filemap['length']:]
-                else:
-                    piece = piece[filemap['length']:]
+            self.downloaded += sum(x['length'] for x in self.map_piece(index) if x['needed'])
 
     def stop_download(self):
         '''
         Send trackers GET requests indicating that download has stopped.
         If we don't send this message, tracker won't give us peer-list next time.
+        Downloaded pieces that are still being hashed or haven't been
+        inserted yet and queued pieces are written first, then all open
+        files are closed and resume file is saved.
         '''
+        self.insert_pieces(self.completed)
+        self.insert_pieces(self.scheduler.take_completed(True))
+        self.writer.close()
+        self.finish_writes()
         for tracker in [x for x in self.trackers if x.reachable]:
             tracker.update_payload(
                 {'event': 'stopped', 'numwant': 0,
@@ -377,10 +494,15 @@ class Torrent(object):
                  'uploaded': self.uploaded}
             )
             tracker.announce()
+        self.cache.forget(self)
+        self.storage.close()
+        self.save_resume()
 
-def download(torrents, speed_limit, seed):
+def run(torrents, seed, start, process_download, process_seeding, close):
     '''
-    Start and stop process of downloading.
+    Start and stop process of downloading. Engine gives functions that start
+    connecting to peers, run download (it gets total length and downloaded
+    bytes) and seeding loops and close all connections.
     '''
     downloaded = 0
     length = 0
@@ -392,12 +514,8 @@ def download(torrents, speed_limit, seed):
         return
     print('Connecting to peers...')
     try:
-        for torrent in torrents:
-            torrent.update_peer_list(True)
-            torrent.start_time = time.time()
-        netloop = Thread(target=SocketHandler.loop)
-        netloop.start()
-        process_download(torrents, length, downloaded, speed_limit)
+        start()
+        process_download(length, downloaded)
     except KeyboardInterrupt:
         seed = False
     if seed:
@@ -406,13 +524,12 @@ def download(torrents, speed_limit, seed):
             for peer in [peer for peer in torrent.peers if not peer.upload]:
                 peer.close()
         try:
-            process_seeding(torrents)
+            process_seeding()
         except KeyboardInterrupt:
             print('\nStopping seeding...')
     else:
         print('\nStopping download...')
-    SocketHandler.close()
-    netloop.join()
+    close()
     for torrent in torrents:
         torrent.stop_download()
     if seed:
@@ -420,6 +537,26 @@ def download(torrents, speed_limit, seed):
     else:
         print('Download completed')
 
+def download(torrents, speed_limit, seed):
+    '''
+    Start and stop process of downloading. Sockets are handled by network thread.
+    '''
+    netloop = Thread(target=SocketHandler.loop)
+    def start():
+        for torrent in torrents:
+            torrent.update_peer_list(True)
+            torrent.start_time = time.time()
+        netloop.start()
+    def close():
+        SocketHandler.close()
+        if netloop.is_alive():
+            netloop.join()
+    run(
+        torrents, seed, start,
+        lambda length, downloaded: process_download(torrents, length, downloaded, speed_limit),
+        lambda: process_seeding(torrents), close
+    )
+
 def process_seeding(torrents):
     '''
     When download completed, this function continues to seed to peers.
@@ -428,20 +565,34 @@ def process_seeding(torrents):
     start_time = time.time()
     time.sleep(0.5)
     while True:
-        peers = 0
-        uploaded = 0
         for torrent in torrents:
             torrent.update_peer_list(False)
-            uploaded += torrent.uploaded
-            peers += len(torrent.peers)
-        upspeed = round((uploaded/len(torrents))/(1024*(time.time()-start_time)), 2)
-        sys.stdout.write(
-            '\rUpload speed: {}{} KB/s. {} peers. '.format(
-                str(upspeed), ' '*(7-len(str(upspeed))), str(peers)
-            )
-        )
+            torrent.send_blocks_to_peers()
+        show_seeding_state(torrents, start_time)
         time.sleep(0.5)
 
+def show_seeding_state(torrents, start_time):
+    '''
+    Print state of seeding of all torrents.
+    '''
+    peers = 0
+    uploaded = 0
+    for torrent in torrents:
+        uploaded += torrent.uploaded
+        peers += len(torrent.peers)
+    upspeed = round((uploaded/len(torrents))/(1024*(time.time()-start_time)), 2)
+    print_seeding_state(upspeed, peers)
+
+def print_seeding_state(upspeed, peers):
+    '''
+    Print current state of seeding in one line.
+    '''
+    sys.stdout.write(
+        '\rUpload speed: {}{} KB/s. {} peers. '.format(
+            str(upspeed), ' '*(7-len(str(upspeed))), str(peers)
+        )
+    )
+
 def process_download(torrents, length, downloaded, speed_limit):
     '''
     Download file. Basically, this function is an infinite loop that
@@ -450,31 +601,54 @@ def process_download(torrents, length, downloaded, speed_limit):
     '''
     print('Download started')
     start_time = time.time() - 0.1
-    endgame = round(100*(downloaded)/length, 2) > ENDGAME_PERCENT
     speed = 0
     while downloaded < length:
-        got = 0
-        uploaded = 0
-        peers = 0
-        downloaded = 0
+        endgame = round(100*(downloaded)/length, 2) > ENDGAME_PERCENT
         for torrent in torrents:
             need_peers = not speed_limit or speed < speed_limit + SPEED_DELTA
             torrent.update_peer_list(need_peers)
             completed_pieces = torrent.check_peers(endgame)
-            torrent.insert_pieces(completed_pieces, endgame)
-            got += torrent.got
-            uploaded += torrent.uploaded
-            peers += len(torrent.peers)
-            downloaded += torrent.downloaded
-        perc = round(100*(downloaded)/length, 2)
-        speed = round((got/len(torrents))/(1024*(time.time()-start_time)), 2)
-        upspeed = round((uploaded/len(torrents))/(1024*(time.time()-start_time)), 2)
-        endgame = perc > ENDGAME_PERCENT
-        sys.stdout.write(
-            '\r{}{}% downloaded. Speed {}{} KB/s. {} peers. Upload speed: {}{} KB/s '.format(
-                str(perc), ' '*(5-len(str(perc))), str(speed),
-                ' '*(7-len(str(speed))), str(peers), str(upspeed),
-                ' '*(7-len(str(upspeed)))
-            )
+            torrent.send_blocks_to_peers()
+            torrent.insert_pieces(completed_pieces)
+            torrent.finish_writes()
+            if time.time() - torrent.resume_time > RESUME_INTERVAL:
+                torrent.save_resume()
+        downloaded, speed = show_download_state(torrents, length, start_time)
+        time.sleep(REFILL_INTERVAL)
+
+def show_download_state(torrents, length, start_time):
+    '''
+    Print state of download of all torrents. Return downloaded bytes and
+    download speed.
+    '''
+    got = 0
+    uploaded = 0
+    peers = 0
+    queued = 0
+    downloaded = 0
+    for torrent in torrents:
+        got += torrent.got
+        uploaded += torrent.uploaded
+        peers += len(torrent.peers)
+        queued += torrent.writer.depth()
+        downloaded += torrent.downloaded
+    buffers = round(Torrent.budget.used/(1024*1024), 2)
+    perc = round(100*(downloaded)/length, 2)
+    speed = round((got/len(torrents))/(1024*(time.time()-start_time)), 2)
+    upspeed = round((uploaded/len(torrents))/(1024*(time.time()-start_time)), 2)
+    print_download_state(perc, speed, peers, upspeed, queued, buffers)
+    return downloaded, speed
+
+def print_download_state(perc, speed, peers, upspeed, queued=0, buffers=0):
+    '''
+    Print current state of download in one line. Buffers is memory taken
+    by piece buffers in MB.
+    '''
+    sys.stdout.write(
+        '\r{}{}% downloaded. Speed {}{} KB/s. {} peers. Upload speed: {}{} KB/s. '
+        'Disk queue: {} Buffers: {} MB '.format(
+            str(perc), ' '*(5-len(str(perc))), str(speed),
+            ' '*(7-len(str(speed))), str(peers), str(upspeed),
+            ' '*(7-len(str(upspeed))), str(queued), str(buffers)
         )
-        time.sleep(0.5)
+    )
@@ -52,12 +52,12 @@ class Tracker(object):
         if self.payload['event'] == 'stopped':
             return b''
         del self.payload['event']
-        response = bendecode(resp.decode("latin1"))
+        response = bendecode(resp)
         self.refresh_time = response['interval']
         self.last_announce = time.time()
         if not 'peers' in response:
             return None
-        return bytes(response['peers'], 'latin1')
+        return response['peers']
 
     def announce_udp(self):
         '''
@@ -1,23 +1,60 @@
+import io
+import os
+import time
+import tempfile
 import unittest
 import mock
 import struct
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from selectors import EVENT_READ, EVENT_WRITE
 import core.torrent
 from LeetTorrent import check_file
-from core.becnode import bendecode, benencode
-from core.network import Peer, construct_message
+from core.becnode import bendecode, benencode, bendump, StreamDecoder, NEED_MORE
+from core.network import Peer, Server, SocketHandler, construct_message
+from core.aio import AsyncPeer, AsyncServer, AsyncTorrent, wait, TICK, PASS_INTERVAL
 from core.tracker import Tracker
 from core.torrent import Torrent
+from core.pieces import PieceTable, Availability
+from core.picker import RarestFirstPicker
+from core.scheduler import BlockScheduler, MemoryBudget, BLOCK_TIMEOUT, RATE_INTERVAL, \
+                           REFILL_INTERVAL, MAX_WINDOW
+from core.config import SNUB_TIME
+from core.storage import Storage, MmapStorage, FileSpan, DiskWriter
+from core.cache import PieceCache
 from hashlib import sha1
 
+def queued(peer):
+    '''
+    Return all data queued to be sent to peer.
+    '''
+    return b''.join(bytes(x) for message in list(peer.control) + list(peer.bulk) for x in message)
+
 class TestBencode(unittest.TestCase):
     def test_encoder_correct_type(self):
-        self.assertEqual(benencode('Hello, World'), '12:Hello, World')
-        self.assertEqual(benencode(('Hello, World', 72, [2, 1])), 't12:Hello, Worldi72eli2ei1eee')
-        self.assertEqual(benencode(58230596782467402), 'i58230596782467402e')
+        self.assertEqual(benencode('Hello, World'), b'12:Hello, World')
+        self.assertEqual(benencode(('Hello, World', 72, [2, 1])), b't12:Hello, Worldi72eli2ei1eee')
+        self.assertEqual(benencode(58230596782467402), b'i58230596782467402e')
         self.assertEqual(benencode({'foo': 'bar', 'hello': 6, 'test': [2, 3, 1488], 'yo': {'Root': 'Head'}}),
-                         'd3:foo3:bar5:helloi6e4:testli2ei3ei1488ee2:yod4:Root4:Headee')
+                         b'd3:foo3:bar5:helloi6e4:testli2ei3ei1488ee2:yod4:Root4:Headee')
         self.assertEqual(benencode([1, 2, 3, '19', 'Jonas', {'Foxtrot': 'Uniform', 'Charlie': ['Kilo']}]),
-                         'li1ei2ei3e2:195:Jonasd7:Charliel4:Kiloe7:Foxtrot7:Uniformee')
+                         b'li1ei2ei3e2:195:Jonasd7:Charliel4:Kiloe7:Foxtrot7:Uniformee')
+        self.assertEqual(benencode([b'\x00\xff', memoryview(b'ab'), bytearray(b'c'), 'я']),
+                         b'l2:\x00\xff2:ab1:c2:\xd1\x8fe')
+
+    def test_encoder_round_trip(self):
+        data = b'd4:infod6:lengthi7e4:name3:\xd1\x8fa6:pieces2:\x00\xffe1:xli-1eee'
+        self.assertEqual(benencode(bendecode(data)), data)
+
+    def test_encoder_sink(self):
+        sink = io.BytesIO()
+        bendump({'peers': b'\x7f\x00\x00\x01\x1a\xe1', 'interval': 100}, sink)
+        self.assertEqual(sink.getvalue(), b'd8:intervali100e5:peers6:\x7f\x00\x00\x01\x1a\xe1e')
+        sink = bytearray(b'prefix')
+        bendump([1], sink)
+        self.assertEqual(sink, b'prefixli1ee')
+        self.assertRaises(TypeError, bendump, {1, 2}, io.BytesIO())
 
     def test_encoder_wrong_type(self):
         self.assertRaises(TypeError, benencode, None)
@@ -26,58 +63,135 @@ class TestBencode(unittest.TestCase):
         self.assertRaises(TypeError, benencode, {'lala': 2, 'jones': False})
 
     def test_decoder_correct_string(self):
-        self.assertEqual(bendecode('12:Hello, World'), 'Hello, World')
-        self.assertEqual(bendecode('t12:Hello, Worldi72ee'), ('Hello, World', 72))
-        self.assertEqual(bendecode('i58230596782467402e'), 58230596782467402)
-        self.assertEqual(bendecode('d3:foo3:bar5:helloi6e4:testli2ei3ei1488ee2:yod4:Root4:Headee'),
-                         {'foo': 'bar', 'hello': 6, 'test': [2, 3, 1488], 'yo': {'Root': 'Head'}})
-        self.assertEqual(bendecode('li1ei2ei3e2:195:Jonasd7:Charliel4:Kiloe7:Foxtrot7:Uniformee'),
-                         [1, 2, 3, '19', 'Jonas', {'Foxtrot': 'Uniform', 'Charlie': ['Kilo']}])
-        self.assertEqual(bendecode('i3e4:kakali74ed3:gag1:ge8:umbrellae'), 3)
+        self.assertEqual(bendecode(b'12:Hello, World'), b'Hello, World')
+        self.assertEqual(bendecode(b't12:Hello, Worldi72ee'), (b'Hello, World', 72))
+        self.assertEqual(bendecode(b'i58230596782467402e'), 58230596782467402)
+        self.assertEqual(bendecode(b'd3:foo3:bar5:helloi6e4:testli2ei3ei1488ee2:yod4:Root4:Headee'),
+                         {'foo': b'bar', 'hello': 6, 'test': [2, 3, 1488], 'yo': {'Root': b'Head'}})
+        self.assertEqual(bendecode(b'li1ei2ei3e2:195:Jonasd7:Charliel4:Kiloe7:Foxtrot7:Uniformee'),
+                         [1, 2, 3, b'19', b'Jonas', {'Foxtrot': b'Uniform', 'Charlie': [b'Kilo']}])
+        self.assertEqual(bendecode(b'i3e4:kakali74ed3:gag1:ge8:umbrellae'), 3)
+        self.assertEqual(bendecode(bytearray(b'4:\x00\xff\x13\x37')), b'\x00\xff\x13\x37')
+        self.assertEqual(bendecode(memoryview(b'li-5ee')), [-5])
+
+    def test_decoder_zero_copy(self):
+        data = b'd6:pieces40:' + b'a'*20 + b'b'*20 + b'e'
+        pieces = bendecode(data)['pieces']
+        self.assertIsInstance(pieces, memoryview)
+        self.assertIs(pieces.obj, data)
+        self.assertEqual(pieces[20:40], b'b'*20)
+
+    def test_decoder_raw_values(self):
+        info = b'd6:lengthi0100e4:name1:ae'
+        data = b'd8:announce3:url4:info' + info + b'e'
+        raw = {}
+        self.assertEqual(bendecode(data, raw)['info'], {'length': 100, 'name': b'a'})
+        self.assertEqual(raw['info'], info)
+        self.assertEqual(raw['announce'], b'3:url')
+        self.assertEqual(sha1(raw['info']).digest(), sha1(info).digest())
+        raw = {}
+        self.assertEqual(bendecode(b'li1ee', raw), [1])
+        self.assertEqual(raw, {})
 
     def test_decoder_incorrect_string(self):
-        self.assertRaises(ValueError, bendecode, 'l3:den6:jjae')
-        self.assertRaises(ValueError, bendecode, 'di666e5:lalal3:keke')
-        self.assertRaises(ValueError, bendecode, 'di666e5:lalal')
-        self.assertRaises(ValueError, bendecode, 'l3:den4:jaja')
-        self.assertRaises(TypeError, bendecode, 'dli666e4:liste5:lalale')
-        self.assertRaises(ValueError, bendecode, 'l3:fo4:reste')
-        self.assertRaises(ValueError, bendecode, 'dla3gaae')
+        self.assertRaises(ValueError, bendecode, b'l3:den6:jjae')
+        self.assertRaises(ValueError, bendecode, b'di666e5:lalal3:keke')
+        self.assertRaises(ValueError, bendecode, b'di666e5:lalal')
+        self.assertRaises(ValueError, bendecode, b'l3:den4:jaja')
+        self.assertRaises(TypeError, bendecode, b'dli666e4:liste5:lalale')
+        self.assertRaises(ValueError, bendecode, b'l3:fo4:reste')
+        self.assertRaises(ValueError, bendecode, b'dla3gaae')
+        self.assertRaises(ValueError, bendecode, b'10:short')
+        self.assertRaises(ValueError, bendecode, b'')
 
     def test_decoder_wrong_type(self):
         self.assertRaises(TypeError, bendecode, None)
         self.assertRaises(TypeError, bendecode, True)
         self.assertRaises(TypeError, bendecode, [1, 2])
-        self.assertRaises(TypeError, bendecode, b'presidentcocojambo')
+        self.assertRaises(TypeError, bendecode, 'presidentcocojambo')
+
+class TestStreamDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = StreamDecoder()
+
+    def test_chunks(self):
+        data = b'd8:intervali1800e5:peers12:\x7f\x00\x00\x01\x1a\xe1' \
+               b'\x7f\x00\x00\x02\x1a\xe14:listli-3et1:aeee'
+        for byte in data[:-1]:
+            self.decoder.feed(bytes([byte]))
+            self.assertIs(self.decoder.get(), NEED_MORE)
+        self.decoder.feed(data[-1:])
+        self.assertEqual(self.decoder.get(), bendecode(data))
+        self.assertEqual(self.decoder.buffer, b'')
+
+    def test_several_values(self):
+        self.decoder.feed(b'i1e3:abcl')
+        self.assertEqual(self.decoder.get(), 1)
+        self.assertEqual(self.decoder.get(), b'abc')
+        self.assertIs(self.decoder.get(), NEED_MORE)
+        self.decoder.feed(b'e4:spam')
+        self.assertEqual(self.decoder.get(), [])
+        self.assertEqual(self.decoder.get(), b'spam')
+        self.assertIs(self.decoder.get(), NEED_MORE)
+
+    def test_invalid(self):
+        for data in (b'x', b'e', b'i1xe', b'1x:', b'di1ei2ee', b'd1:ae'):
+            decoder = StreamDecoder()
+            decoder.feed(data)
+            self.assertRaises(ValueError, decoder.get)
 
 class TestPeer(unittest.TestCase):
     def setUp(self):
-        self.peer = Peer(b'aBitTorrent protocoltotallynotahandshake')
+        self.peer = Peer(b'\x13BitTorrent protocol' + b'\x00'*8 + b'h'*20 + b'p'*20)
 
     def parser_test(self, mes, expcurm, expcurl, expmsg):
+        self.peer.handshaked = True
         self.assertEqual(self.peer.parse_stream(mes), expmsg)
-        self.assertEqual(self.peer.current_msg, expcurm)
-        self.assertEqual(self.peer.current_msg_len, expcurl)
-        self.peer.current_msg = b''
-        self.peer.current_msg_len = 0
+        self.assertEqual(self.peer.recv_buffer[self.peer.recv_start:self.peer.recv_end], expcurm)
+        self.assertEqual(self.peer.recv_need, expcurl)
+        self.peer.recv_start = self.peer.recv_end
 
     def test_fill_bitfield(self):
         self.peer.fill_bitfield(b'\x00')
-        self.assertEqual(self.peer.bitfield, {0: '0', 1: '0', 2: '0', 3: '0', 4: '0', 5: '0', 6: '0', 7: '0'})
+        self.assertEqual(self.peer.bitfield, b'\x00')
+        self.assertFalse(any(self.peer.has_piece(i) for i in range(10)))
         self.peer.fill_bitfield(b'\x21')
-        self.assertEqual(self.peer.bitfield, {0: '0', 1: '0', 2: '1', 3: '0', 4: '0', 5: '0', 6: '0', 7: '1'})
-        self.peer.fill_bitfield(b'\xA0')
-        self.assertEqual(self.peer.bitfield, {0: '1', 1: '0', 2: '1', 3: '0', 4: '0', 5: '0', 6: '0', 7: '0'})
-        self.peer.fill_bitfield(b'\xAA')
-        self.assertEqual(self.peer.bitfield, {0: '1', 1: '0', 2: '1', 3: '0', 4: '1', 5: '0', 6: '1', 7: '0'})
+        self.assertEqual([i for i in range(10) if self.peer.has_piece(i)], [2, 7])
+        self.peer.fill_bitfield(b'\xA0\x01')
+        self.assertEqual([i for i in range(20) if self.peer.has_piece(i)], [0, 2, 15])
+        self.peer.add_piece(30)
+        self.assertEqual(self.peer.bitfield, b'\xA0\x01\x00\x02')
+        self.assertTrue(self.peer.has_piece(30))
+
+    def test_availability(self):
+        swarm = Availability(10)
+        first = Peer(b'', swarm=swarm)
+        second = Peer(b'', swarm=swarm)
+        first.fill_bitfield(b'\xC0\x40')
+        second.add_piece(1)
+        second.add_piece(1)
+        second.add_piece(9)
+        second.add_piece(12)
+        second.add_piece(2**30)
+        self.assertEqual(second.bitfield, b'\x40\x40')
+        self.assertEqual(list(swarm.counts), [1, 2, 0, 0, 0, 0, 0, 0, 0, 2])
+        first.fill_bitfield(b'\x00\x00')
+        self.assertEqual(list(swarm.counts), [0, 1, 0, 0, 0, 0, 0, 0, 0, 1])
+        second.close()
+        second.close()
+        self.assertEqual(list(swarm.counts), [0]*10)
+        first.close()
 
     def test_parser_normal_messages(self):
-        message = self.peer.handshake
-        self.assertEqual(self.peer.parse_stream(message), None)
-        message = b'aBitTorrent protocoltotallynotahandshketjty'
-        self.assertEqual(self.peer.parse_stream(message), None)
-        self.assertFalse(self.peer.alive)
-        self.peer.alive = True
+        wrong = Peer(self.peer.handshake)
+        self.assertEqual(wrong.parse_stream(self.peer.handshake[:28] + b'x'*40), [])
+        self.assertFalse(wrong.alive)
+        self.assertEqual(self.peer.parse_stream(self.peer.handshake[:30]), [])
+        self.assertFalse(self.peer.handshaked)
+        message = self.peer.handshake[30:] + construct_message('unchoke')
+        self.assertEqual(self.peer.parse_stream(message), [(1, b'')])
+        self.assertTrue(self.peer.handshaked)
+        self.assertTrue(self.peer.need_bitfield)
         message = construct_message('keep-alive')
         self.assertEqual(self.peer.parse_stream(message), [])
         message = construct_message('choke')+construct_message('choke')+construct_message('choke')
@@ -100,6 +214,29 @@ class TestPeer(unittest.TestCase):
         message = construct_message('have', 4)+b'\x00\x00\x00\xA4\x05\x00\x00\x00\x00\x00\x00'
         self.parser_test(message, b'\x00\x00\x00\xA4\x05\x00\x00\x00\x00\x00\x00', 168, [(4, b'\x00\x00\x00\x04')])
 
+    def test_parser_large_message(self):
+        self.peer.handshaked = True
+        bitfield = bytes(range(256))*400
+        message = struct.pack('!IB', len(bitfield)+1, 5) + bitfield
+        for start in range(0, len(message), 10000):
+            messages = self.peer.parse_stream(message[start:start+10000])
+        self.assertEqual(messages, [(5, bitfield)])
+        self.assertEqual(self.peer.recv_start, self.peer.recv_end)
+
+    def test_block_destination(self):
+        self.peer.handshaked = True
+        piece = bytearray(10)
+        self.peer.request_block(1, 4, 6, memoryview(piece)[4:])
+        self.peer.request_block(1, 0, 4)
+        self.peer.handle_messages(self.peer.parse_stream(
+            construct_message('piece', 15, 1, 4, b'lalala') + construct_message('piece', 13, 1, 0, b'haha')
+        ))
+        self.assertEqual(piece, b'\x00'*4 + b'lalala')
+        blocks = self.peer.take_blocks()
+        self.assertEqual([x[4] for x in blocks], [True, False])
+        self.assertEqual(blocks[1][2], b'haha')
+        self.assertIsInstance(blocks[1][2], bytes)
+
     def test_construct_message(self):
         self.assertEqual(construct_message('have', 4), b'\x00\x00\x00\x05\x04\x00\x00\x00\x04')
         self.assertEqual(construct_message('piece', 10, b'abcdef'), b'\x00\x00\x00\n\x07abcdef')
@@ -112,40 +249,101 @@ class TestPeer(unittest.TestCase):
         self.assertFalse(self.peer.alive)
         self.peer.alive = True
         self.peer.handle_messages([(1, None), (4, b'\x00\x00\x00\xFF')])
-        self.assertTrue(self.peer.bitfield[255])
+        self.assertTrue(self.peer.has_piece(255))
         self.assertTrue(self.peer.unchoked)
         self.peer.handle_messages([(5, b'\xAA'), (2, None)])
-        self.assertEqual(self.peer.write_buffer, b'\x00\x00\x00\x01\x02')
+        self.assertEqual(queued(self.peer), b'\x00\x00\x00\x01\x02')
         self.peer.upload = True
-        self.peer.write_buffer = b''
+        self.peer.control.clear()
         self.peer.handle_messages([(5, b'\xAA'), (2, None)])
-        self.assertEqual(self.peer.write_buffer, b'\x00\x00\x00\x01\x01')
+        self.assertEqual(queued(self.peer), b'\x00\x00\x00\x01\x01')
         self.peer.upload = False
-        self.peer.piece_buffer[1] = {'data': {}, 'blocks_amount': 2}
         self.peer.handle_messages([(7, b'\x00\x00\x00\x01\x00\x00\x00\x04lalala')])
         self.assertEqual(self.peer.downloaded, 6)
-        self.assertEqual(self.peer.piece_buffer[1]['data'][4], b'lalala')
+        self.assertEqual(self.peer.received[0][:3], (1, 4, b'lalala'))
         self.peer.handle_messages([(6, b'\x00\x00\x00\x01\x00\x00\x00\x04\x00\x00\x00\x00')])
         self.assertEqual(self.peer.need_piece[1], [(4, 0)])
 
     def test_save_block(self):
-        self.peer.piece_buffer[1] = {'data': {}, 'blocks_amount': 2}
         self.peer.save_block(b'\x00\x00\x00\x01\x00\x00\x00\x04lalala')
         self.assertEqual(self.peer.downloaded, 6)
-        self.assertEqual(self.peer.piece_buffer[1]['data'][4], b'lalala')
         self.peer.save_block(b'\x00\x00\x00\x01\x00\x00\x00\x06lalalala')
         self.assertEqual(self.peer.downloaded, 14)
-        self.assertEqual(self.peer.piece_buffer, {})
-        self.assertEqual(self.peer.get_completed_pieces(), {1: b'lalalalalalala'})
-
-    def test_send_request(self):
-        self.peer.write_buffer = b''
-        self.peer.send_request({4:40000})
-        self.assertEqual(self.peer.write_buffer, struct.pack('!'+'IBIII'*3, 13, 6, 4, 0, 16384, 13, 6, 4, 16384, 16384, 13, 6, 4, 16384*2, 40000-16384*2))
-        self.peer.write_buffer = b''
-        self.peer.send_request({4:17, 200:75})
-        self.assertTrue(struct.pack('!'+'IBIII', 13, 6, 4, 0, 17 in self.peer.write_buffer))
-        self.assertTrue(struct.pack('!'+'IBIII', 13, 6, 200, 0, 75 in self.peer.write_buffer))
+        self.assertEqual([x[:3] for x in self.peer.take_blocks()], [(1, 4, b'lalala'), (1, 6, b'lalalala')])
+        self.assertEqual(self.peer.take_blocks(), [])
+
+    def test_write_interest(self):
+        local, remote = socket.socketpair()
+        peer = Peer(b'', sock=local)
+        key = SocketHandler.selector.get_key(local)
+        self.assertEqual(key.events, EVENT_READ)
+        peer.push(b'lalala')
+        self.assertEqual(SocketHandler.selector.get_key(local).events, EVENT_READ | EVENT_WRITE)
+        SocketHandler.handle_socket(peer, EVENT_WRITE)
+        self.assertEqual(remote.recv(6), b'lalala')
+        self.assertEqual(SocketHandler.selector.get_key(local).events, EVENT_READ)
+        remote.close()
+        SocketHandler.handle_socket(peer, EVENT_READ)
+        self.assertFalse(peer.alive)
+        self.assertNotIn(peer, [x.data for x in SocketHandler.selector.get_map().values()])
+
+    def test_accepted_handshake(self):
+        server = Server(0)
+        client = socket.create_connection(('127.0.0.1', server.port))
+        while not server.peers:
+            server.accept()
+        handshake = b'\x13BitTorrent protocol' + b'\x00'*8 + b'h'*20
+        peer = Peer(handshake + b's'*20, True, server.take_number_of_peers(1)[0])
+        client.sendall(handshake + b'c'*20)
+        while not peer.handshaked:
+            SocketHandler.handle_socket(peer, EVENT_READ)
+        while peer.control or peer.wire:
+            SocketHandler.handle_socket(peer, EVENT_WRITE)
+        client.setblocking(False)
+        self.assertEqual(client.recv(1000), handshake + b's'*20)
+        self.assertTrue(peer.alive)
+        self.assertTrue(peer.need_bitfield)
+        peer.close()
+        client.close()
+        server.close()
+
+    def test_control_priority(self):
+        local, remote = socket.socketpair()
+        remote.setblocking(False)
+        peer = Peer(b'', sock=local)
+        peer.need_piece = {index: [(0, 2**14)] for index in range(10)}
+        for index in range(10):
+            peer.send_block(bytes([index])*2**14, index, (0, 2**14))
+        stream = bytearray()
+        SocketHandler.handle_socket(peer, EVENT_WRITE)
+        peer.send_have(7)
+        while peer.wire or peer.control or peer.bulk:
+            SocketHandler.handle_socket(peer, EVENT_WRITE)
+            try:
+                stream += remote.recv(2**20)
+            except BlockingIOError:
+                pass
+        while len(stream) < 10*(2**14 + 13) + 9:
+            stream += remote.recv(2**20)
+        self.assertEqual(stream[4*(2**14 + 13):][:9], construct_message('have', 7))
+        self.assertEqual(stream[-(2**14 + 13):][:13], struct.pack('!IBII', 2**14 + 9, 7, 9, 0))
+        peer.close()
+        remote.close()
+
+    def test_request_block(self):
+        self.peer.control.clear()
+        self.peer.unchoked = True
+        self.peer.window = 2
+        self.peer.request_block(4, 16384, 100)
+        self.assertTrue(self.peer.can_request())
+        self.peer.request_block(4, 0, 16384)
+        self.assertFalse(self.peer.can_request())
+        self.assertEqual(queued(self.peer), struct.pack('!'+'IBIII'*2, 13, 6, 4, 16384, 100, 13, 6, 4, 0, 16384))
+        self.assertEqual(sorted(self.peer.outstanding), [(4, 0), (4, 16384)])
+        self.peer.control.clear()
+        self.peer.cancel_block(4, 0, 16384)
+        self.assertEqual(queued(self.peer), struct.pack('!IBIII', 13, 8, 4, 0, 16384))
+        self.assertEqual(list(self.peer.outstanding), [(4, 16384)])
 
 class TestTracker(unittest.TestCase):
     def setUp(self):
@@ -173,20 +371,122 @@ class TestTorrent(unittest.TestCase):
 
     def test_get_pieces(self):
         self.torrent.length = 111
-        self.assertEqual(self.torrent.get_pieces({'pieces': 'bbbb'*5, 'piece length': 111}), [{'hash': b'bbbb'*5, 'have': False, 'requested': (False, None), 'size': 111, 'offset': 0}])
+        pieces = self.torrent.get_pieces({'pieces': memoryview(b'bbbb'*5), 'piece length': 111})
+        self.assertEqual(len(pieces), 1)
+        self.assertEqual(pieces.hash(0), b'bbbb'*5)
+        self.assertEqual((pieces.size(0), pieces.offset(0), pieces.has(0), pieces.requested[0]), (111, 0, False, 0))
         self.torrent.length = 350
-        self.assertEqual(self.torrent.get_pieces({'pieces': 'aaaa'*5*4, 'piece length': 100}), 
-                                                 [{'hash': b'aaaa'*5, 'have': False, 'requested': (False, None), 'size': 100, 'offset': 0},
-                                                  {'hash': b'aaaa'*5, 'have': False, 'requested': (False, None), 'size': 100, 'offset': 100},
-                                                  {'hash': b'aaaa'*5, 'have': False, 'requested': (False, None), 'size': 100, 'offset': 200},
-                                                  {'hash': b'aaaa'*5, 'have': False, 'requested': (False, None), 'size': 50, 'offset': 300}])
+        pieces = self.torrent.get_pieces({'pieces': memoryview(b'aaaa'*5*3+b'cccc'*5), 'piece length': 100})
+        self.assertEqual(len(pieces), 4)
+        self.assertEqual(list(pieces.sizes), [100, 100, 100, 50])
+        self.assertEqual([pieces.offset(i) for i in range(4)], [0, 100, 200, 300])
+        self.assertEqual(pieces.hash(3), b'cccc'*5)
 
     def test_construct_bitfield(self):
         self.assertEqual(self.torrent.construct_bitfield(), b'')
-        self.torrent.pieces = [{'have': True}, {'have': False}, {'have': False}]
+        self.torrent.pieces = PieceTable(b'a'*20*3, 1, 3)
+        self.torrent.pieces.set_have(0)
         self.assertEqual(self.torrent.construct_bitfield(), b'\x80')
-        self.torrent.pieces = [{'have': True}, {'have': False}, {'have': False}, {'have': True}, {'have': False}, {'have': False}, {'have': True}, {'have': True}, {'have': True}]
+        self.torrent.pieces = PieceTable(b'a'*20*9, 1, 9)
+        bitfield = self.torrent.construct_bitfield()
+        for index in (0, 3, 6, 7, 8):
+            self.torrent.pieces.set_have(index)
         self.assertEqual(self.torrent.construct_bitfield(), b'\x93\x80')
+        self.assertEqual(bitfield, b'\x93\x80')
+
+    def test_send_bitfield(self):
+        peer = Peer(b'')
+        peer.need_bitfield = True
+        self.torrent.peers = [peer]
+        self.torrent.pieces = PieceTable(b'a'*20*9, 1, 9)
+        self.torrent.pieces.set_have(8)
+        self.torrent.start_time = time.time() - 1
+        self.torrent.send_blocks_to_peers()
+        self.assertEqual(queued(peer), b'\x00\x00\x00\x03\x05\x00\x80')
+        self.assertFalse(peer.need_bitfield)
+        peer.close()
+
+    def test_upload_blocks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            data = bytes(range(200))
+            self.torrent.files = [{'path': os.path.join(folder, 'a'), 'length': 150, 'needed': True},
+                                  {'path': os.path.join(folder, 'b'), 'length': 50, 'needed': True}]
+            self.torrent.index_files()
+            with open(self.torrent.files[0]['path'], 'wb') as file_:
+                file_.write(data[:150])
+            with open(self.torrent.files[1]['path'], 'wb') as file_:
+                file_.write(data[150:])
+            self.torrent.pieces = PieceTable(b'a'*40, 100, 200)
+            self.torrent.pieces.set_have(1)
+            self.torrent.start_time = time.time() - 1
+            local, remote = socket.socketpair()
+            peer = Peer(b'', sock=local)
+            self.torrent.peers = [peer]
+            peer.handle_messages([(6, struct.pack('!III', 1, 40, 20)), (6, struct.pack('!III', 1, 0, 30)),
+                                  (6, struct.pack('!III', 0, 0, 10))])
+            self.torrent.send_blocks_to_peers()
+            self.assertNotIsInstance(peer.bulk[0][1], FileSpan)
+            self.assertIsInstance(peer.bulk[1][1], FileSpan)
+            while peer.bulk or peer.wire:
+                peer.send()
+            expected = construct_message('piece', 29, 1, 40, data[140:160]) + \
+                       construct_message('piece', 39, 1, 0, data[100:130])
+            self.assertEqual(remote.recv(1000), expected)
+            self.assertEqual(peer.need_piece, {1: [], 0: [(0, 10)]})
+            self.assertEqual(self.torrent.uploaded, 50)
+            peer.close()
+            remote.close()
+            self.torrent.storage.close()
+
+    def test_insert_pieces(self):
+        self.torrent.pieces = PieceTable(sha1(b'foo').digest()+sha1(b'bar').digest(), 3, 6)
+        self.torrent.picker = mock.MagicMock()
+        self.torrent.writer = mock.MagicMock()
+        self.torrent.files = [{'path': 'a', 'length': 6, 'needed': True}]
+        self.torrent.index_files()
+        self.torrent.pieces.set_have(1)
+        self.torrent.budget = MemoryBudget()
+        self.torrent.budget.take(9)
+        self.torrent.insert_pieces({0: b'foo', 1: b'bar'})
+        self.torrent.insert_pieces({0: b'foo'})
+        self.assertEqual(self.torrent.writing, {0})
+        self.assertEqual(self.torrent.got, 3)
+        self.torrent.writer.put.assert_called_once_with(0, self.torrent.map_piece(0), b'foo')
+        self.torrent.picker.remove.assert_called_once_with(0)
+        self.assertEqual(self.torrent.budget.used, 3)
+
+    def test_stop_download(self):
+        self.torrent.pieces = PieceTable(b'a'*40, 3, 6)
+        self.torrent.files = [{'path': 'a', 'length': 6, 'needed': True}]
+        self.torrent.index_files()
+        for name in ('scheduler', 'picker', 'writer', 'storage', 'save_resume'):
+            setattr(self.torrent, name, mock.MagicMock())
+        self.torrent.budget = MemoryBudget()
+        self.torrent.completed = {0: b'foo'}
+        self.torrent.scheduler.take_completed.return_value = {1: b'bar'}
+        self.torrent.writer.take_done.return_value = []
+        self.torrent.stop_download()
+        self.torrent.scheduler.take_completed.assert_called_once_with(True)
+        self.assertEqual([x[0][0] for x in self.torrent.writer.put.call_args_list], [0, 1])
+        self.assertEqual(self.torrent.completed, {})
+        self.torrent.writer.close.assert_called_once_with()
+        self.torrent.save_resume.assert_called_once_with()
+
+    def test_run(self):
+        torrent = mock.MagicMock(downloaded=5, length=10)
+        seeding = mock.MagicMock()
+        torrent.peers = [seeding, mock.MagicMock(upload=False)]
+        calls = []
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            core.torrent.run([torrent], True, lambda: calls.append('start'),
+                             lambda length, downloaded: calls.append((length, downloaded)),
+                             lambda: calls.append('seed'), lambda: calls.append('close'))
+            self.assertEqual(calls, ['start', (10, 5), 'seed', 'close'])
+            torrent.stop_download.assert_called_once_with()
+            torrent.peers[1].close.assert_called_once_with()
+            seeding.close.assert_not_called()
+            torrent.downloaded = 10
+            core.torrent.run([torrent], False, *[None]*4)
 
     def test_update_peers(self):
         mock_dead_peer = mock.MagicMock()
@@ -215,28 +515,533 @@ class TestTorrent(unittest.TestCase):
                     self.assertEqual(len(self.torrent.backup_peers), 1)
 
     def test_map_piece(self):
-        self.torrent.files = [{'path': 'kiki', 'length': 23}]
-        self.torrent.pieces = [{'offset': 0, 'size': 23}]
-        self.assertEqual(self.torrent.map_piece(0), [{'file': {'path': 'kiki', 'length': 23}, 'needed': True, 'offset': 0, 'length': 23}])
+        self.torrent.files = [{'path': 'kiki', 'length': 23, 'needed': True}]
+        self.torrent.index_files()
+        self.torrent.pieces = PieceTable(b'a'*20, 23, 23)
+        self.assertEqual(self.torrent.map_piece(0), [{'file': {'path': 'kiki', 'length': 23, 'needed': True}, 'needed': True, 'offset': 0, 'length': 23}])
         self.torrent.files = [{'length': 3, 'needed': True}, {'length': 40, 'needed': True}]
+        self.torrent.index_files()
         self.assertEqual(self.torrent.map_piece(0), [{'file': {'needed': True, 'length': 3}, 'needed': True, 'length': 3, 'offset':0},
                                                       {'file': {'needed': True, 'length': 40}, 'needed': True, 'length': 20, 'offset': 0}])
         self.torrent.files = [{'length': 22, 'needed': True}, {'length': 19, 'needed': False}, {'length': 40, 'needed': True}]
+        self.torrent.index_files()
         self.torrent.piece_length = 24
-        self.torrent.pieces = [{'offset': 4, 'size': 19}, {'offset': 4, 'size': 19}]
+        self.torrent.pieces = PieceTable(b'a'*40, 24, 43)
         self.assertEqual(self.torrent.map_piece(1), [{'offset': 2, 'needed': False, 'file': {'needed': False, 'length': 19}, 'length': 17}, 
                                                       {'offset': 0, 'needed': True, 'file': {'needed': True, 'length': 40}, 'length': 2}])
 
+    def test_map_range(self):
+        self.torrent.files = [{'length': 5, 'needed': True}, {'length': 0, 'needed': True},
+                              {'length': 0, 'needed': False}, {'length': 10, 'needed': False},
+                              {'length': 3, 'needed': True}]
+        self.torrent.index_files()
+        self.assertEqual([(x['file'], x['offset'], x['length']) for x in self.torrent.map_range(5, 11)],
+                         [(self.torrent.files[3], 0, 10), (self.torrent.files[4], 0, 1)])
+        self.assertEqual([(x['file'], x['offset'], x['length']) for x in self.torrent.map_range(4, 2)],
+                         [(self.torrent.files[0], 4, 1), (self.torrent.files[3], 0, 1)])
+        self.assertEqual(self.torrent.map_range(17, 10), [{'file': self.torrent.files[4], 'offset': 2, 'length': 1, 'needed': True}])
+        self.assertEqual(self.torrent.map_range(18, 10), [])
+
     def test_check_data(self):
         with mock.patch('core.torrent.os.path') as mck:
-            with mock.patch('core.torrent.read_file_with_offset') as fmck:
-                mck.exists.return_value = True
-                self.torrent.piece_length = 1
-                self.torrent.pieces = [{'offset': 0, 'size': 19, 'hash': sha1(b'lalala').digest(), 'needed': True}]
-                self.torrent.files = [{'path': 'lala', 'length': 22, 'needed': True}]
-                fmck.return_value = b'lalala'
-                self.assertEqual(self.torrent.check_existing_data(), 19)
-                fmck.assert_called_with({'length': 22, 'path': 'lala', 'needed': True}, 0, 19)
+            mck.exists.return_value = True
+            self.torrent.storage = mock.MagicMock()
+            self.torrent.piece_length = 1
+            self.torrent.pieces = PieceTable(sha1(b'lalala').digest(), 19, 19)
+            self.torrent.pieces.set_needed(0)
+            self.torrent.files = [{'path': 'lala', 'length': 22, 'needed': True}]
+            self.torrent.index_files()
+            self.torrent.storage.read.return_value = b'lalala'
+            self.assertEqual(self.torrent.check_existing_data(), 19)
+            self.torrent.storage.read.assert_called_with(
+                [{'file': {'length': 22, 'path': 'lala', 'needed': True}, 'offset': 0, 'length': 19, 'needed': True}]
+            )
+            self.assertTrue(self.torrent.pieces.has(0))
+
+    def test_check_data_batches(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'a'), 'wb') as file_:
+                file_.write(b'foobarba')
+            self.torrent.files = [{'path': os.path.join(folder, 'a'), 'length': 8, 'needed': True},
+                                  {'path': os.path.join(folder, 'b'), 'length': 3, 'needed': False}]
+            self.torrent.index_files()
+            self.torrent.pieces = PieceTable(sha1(b'foo').digest()+sha1(b'bar').digest()+
+                                             sha1(b'baz').digest()+sha1(b'qux').digest(), 3, 11)
+            for index in range(4):
+                self.torrent.pieces.set_needed(index, index != 3)
+            with mock.patch('core.torrent.CHECK_READ_SIZE', 6):
+                self.assertEqual(self.torrent.check_existing_data(), 6)
+            self.assertEqual(self.torrent.pieces.have, b'\xC0')
+            self.torrent.storage.close()
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name, data in (('a', b'foobar'), ('b', b'bazqux')):
+                with open(os.path.join(folder, name), 'wb') as file_:
+                    file_.write(data)
+            self.torrent.files = [{'path': os.path.join(folder, 'a'), 'length': 6, 'needed': True},
+                                  {'path': os.path.join(folder, 'b'), 'length': 6, 'needed': True}]
+            self.torrent.index_files()
+            self.torrent.pieces = PieceTable(sha1(b'foo').digest()+sha1(b'bar').digest()+
+                                             sha1(b'baz').digest()+sha1(b'qux').digest(), 3, 12)
+            for index in range(4):
+                self.torrent.pieces.set_needed(index)
+            self.torrent.resume_path = os.path.join(folder, '.resume')
+            self.assertEqual(self.torrent.check_existing_data(), 12)
+            self.torrent.pieces.set_have(0, False)
+            self.torrent.save_resume()
+            os.utime(self.torrent.files[1]['path'], ns=(0, 0))
+            self.torrent.pieces.have[:] = b'\x00'
+            with mock.patch.object(self.torrent, 'check_pieces', return_value=[False, False]) as mck, \
+                 mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(self.torrent.check_existing_data(), 3)
+                mck.assert_called_once_with([2, 3])
+            self.assertIn('100.0% checked', out.getvalue())
+            self.assertEqual(self.torrent.pieces.have, b'\x40')
+            os.remove(self.torrent.files[1]['path'])
+            self.assertEqual(self.torrent.load_resume()[1], {self.torrent.files[0]['path']})
+            self.torrent.storage.close()
+
+class TestPicker(unittest.TestCase):
+    def setUp(self):
+        self.picker = RarestFirstPicker(16)
+        for index in range(16):
+            self.picker.add(index)
+        self.peer = Peer(b'', swarm=self.picker)
+        other = Peer(b'', swarm=self.picker)
+        self.peer.fill_bitfield(b'\xFF\x0F')
+        other.fill_bitfield(b'\xF0\x00')
+        other.close()
+        other = Peer(b'', swarm=self.picker)
+        other.fill_bitfield(b'\xFF\x00')
+
+    def tearDown(self):
+        self.peer.close()
+
+    def test_rarest_first(self):
+        self.assertEqual(sorted(self.picker.pick(self.peer, 4)), [12, 13, 14, 15])
+        self.assertEqual(len(set(self.picker.pick(self.peer, 3)) & set(range(8))), 3)
+        self.assertEqual(len(self.picker.pick(self.peer, 10)), 5)
+        self.assertEqual(self.picker.pick(self.peer, 10), [])
+        self.picker.add(14)
+        self.assertEqual(self.picker.pick(self.peer, 10), [14])
+
+    def test_remove_and_update(self):
+        self.picker.add(15)
+        self.picker.remove(13)
+        self.assertFalse(self.picker.pickable[1] & 0x04)
+        self.peer.add_piece(8)
+        self.peer.add_piece(9)
+        self.picker.add_piece(9)
+        self.assertEqual(sorted(self.picker.pick(self.peer, 4)), [8, 12, 14, 15])
+        self.assertEqual(self.picker.buckets[1], [])
+        self.assertEqual(self.picker.counts[9], 2)
+        self.assertIn(9, self.picker.buckets[2])
+
+    def test_large_bucket(self):
+        picker = RarestFirstPicker(4096)
+        rare = Peer(b'', swarm=picker)
+        rare.fill_bitfield(b'\xFF'*511 + b'\xFE')
+        common = Peer(b'', swarm=picker)
+        common.fill_bitfield(bytes(511) + b'\x02')
+        for index in range(4096):
+            picker.add(index)
+        self.assertEqual(len(picker.buckets[1]), 4094)
+        self.assertEqual(picker.pick(common, 2), [4094])
+        self.assertEqual(picker.pick(common, 1), [])
+        picker.add(4094)
+        self.assertEqual(picker.pick(common, 1), [4094])
+        rare.close()
+        common.close()
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.size = 2*2**14 + 100
+        self.data = [bytes([i])*self.size for i in range(3)]
+        self.pieces = PieceTable(b''.join(sha1(x).digest() for x in self.data), self.size, 3*self.size)
+        self.picker = RarestFirstPicker(3)
+        self.scheduler = BlockScheduler(self.pieces, self.picker)
+        self.peers = [Peer(b'', swarm=self.picker) for _ in range(2)]
+        for peer in self.peers:
+            peer.unchoked = True
+            peer.fill_bitfield(b'\xE0')
+        self.picker.add_piece(0)
+        for index in range(3):
+            self.picker.add(index)
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+
+    def deliver(self, peer, index, offset):
+        peer.save_block(struct.pack('!II', index, offset) + self.data[index][offset:offset+2**14])
+        self.scheduler.collect(peer, time.time())
+
+    def test_fill_and_collect(self):
+        first, second = self.peers
+        self.scheduler.fill(first, False)
+        self.assertEqual(len(first.outstanding), 4)
+        self.assertEqual(sorted(self.scheduler.active), sorted(set(x[0] for x in first.outstanding)))
+        self.scheduler.fill(second, False)
+        self.assertEqual(len(second.outstanding), 4)
+        self.assertEqual(len(self.scheduler.active), 3)
+        self.assertFalse(set(first.outstanding) & set(second.outstanding))
+        for peer in self.peers:
+            for index, offset in list(peer.outstanding):
+                self.deliver(peer, index, offset)
+        self.assertEqual(first.outstanding, {})
+        self.scheduler.fill(first, False)
+        self.assertEqual(len(first.outstanding), 1)
+        index, offset = list(first.outstanding)[0]
+        self.deliver(first, index, offset)
+        self.assertEqual(self.scheduler.take_completed(), dict(enumerate(self.data)))
+        self.assertEqual(self.scheduler.active, {})
+        self.assertTrue(first.rtt)
+
+    def test_fast_peer(self):
+        first = self.peers[0]
+        first.rtt = 0.001
+        now = first.rate_time
+        for _ in range(15):
+            now += RATE_INTERVAL
+            first.downloaded += first.window*2**14*RATE_INTERVAL/REFILL_INTERVAL
+            self.scheduler.update_window(first, now)
+        self.assertEqual(first.window, MAX_WINDOW)
+
+    def test_timeouts_and_release(self):
+        first, second = self.peers
+        self.scheduler.fill(first, False)
+        stalled = set(first.outstanding)
+        first.control.clear()
+        self.scheduler.check_timeouts(self.peers, time.time() + BLOCK_TIMEOUT + 1)
+        self.assertEqual(first.outstanding, {})
+        self.assertEqual(len(queued(first)), 4*17)
+        self.scheduler.fill(second, False)
+        self.assertEqual(set(second.outstanding), stalled)
+        second.close()
+        self.scheduler.release_peer(second)
+        self.scheduler.fill(first, False)
+        self.assertEqual(set(first.outstanding), stalled)
+
+    def test_snubbed(self):
+        first, second = self.peers
+        self.scheduler.fill(first, False)
+        requested = set(first.outstanding)
+        first.last_block -= SNUB_TIME + 1
+        self.scheduler.check_timeouts(self.peers, time.time())
+        self.assertTrue(first.snubbed)
+        self.assertEqual(first.outstanding, {})
+        self.scheduler.fill(first, False)
+        self.assertEqual(len(first.outstanding), 1)
+        self.scheduler.fill(second, False)
+        self.assertTrue(requested - set(first.outstanding) <= set(second.outstanding))
+        index, offset = list(first.outstanding)[0]
+        self.deliver(first, index, offset)
+        self.assertFalse(first.snubbed)
+        self.assertTrue(first.can_request())
+
+    def test_silent_peer(self):
+        first = self.peers[0]
+        clock = time.time()
+        with mock.patch('time.time', lambda: clock):
+            self.scheduler.fill(first, False)
+            for _ in range(SNUB_TIME // (BLOCK_TIMEOUT + 1) + 2):
+                clock += BLOCK_TIMEOUT + 1
+                self.scheduler.check_timeouts(self.peers, clock)
+                self.assertTrue(first.stalled)
+                self.scheduler.fill(first, False)
+        self.assertTrue(first.snubbed)
+        self.assertEqual(len(first.outstanding), 1)
+        index, offset = list(first.outstanding)[0]
+        self.deliver(first, index, offset)
+        self.assertFalse(first.snubbed or first.stalled)
+
+    def test_incremental_hash(self):
+        first = self.peers[0]
+        first.window = 10
+        self.scheduler.hash_pool = Torrent.hash_pool
+        self.scheduler.fill(first, False)
+        self.data[1] = b'x' + self.data[1][1:]
+        for offset in (2**14, 0, 2**15):
+            self.deliver(first, 0, offset)
+            self.deliver(first, 1, offset)
+        self.assertEqual(self.scheduler.active[2]['hashed'], 0)
+        self.deliver(first, 2, 0)
+        while self.scheduler.verifying:
+            self.scheduler.verify()
+        self.assertEqual(self.scheduler.active[2]['hashed'], 2**14)
+        self.assertEqual(self.scheduler.take_completed(), {0: self.data[0]})
+        self.assertNotEqual(self.picker.positions[1], -1)
+
+    def test_memory_budget(self):
+        first, second = self.peers
+        first.window = second.window = 10
+        budget = MemoryBudget(self.size + 1)
+        self.scheduler.budget = budget
+        self.scheduler.fill(first, False)
+        self.assertEqual(list(self.scheduler.active), list(set(x[0] for x in first.outstanding)))
+        self.assertEqual(budget.used, self.size)
+        self.data = [b'x'*self.size]*3
+        for index, offset in list(first.outstanding):
+            self.deliver(first, index, offset)
+        self.assertEqual(self.scheduler.take_completed(), {})
+        self.assertEqual(budget.used, 0)
+        self.scheduler.fill(second, False)
+        self.assertEqual(len(self.scheduler.active), 1)
+
+    def test_wait_for_hashes(self):
+        first = self.peers[0]
+        first.window = 10
+        self.scheduler.hash_pool = ThreadPoolExecutor(1)
+        self.scheduler.hash_pool.submit(time.sleep, 0.2)
+        self.scheduler.fill(first, False)
+        for offset in (0, 2**14, 2**15):
+            self.deliver(first, 0, offset)
+        self.assertEqual(self.scheduler.take_completed(), {})
+        self.assertEqual(self.scheduler.take_completed(True), {0: self.data[0]})
+        self.scheduler.hash_pool.shutdown()
+
+    def test_endgame(self):
+        first, second = self.peers
+        first.window = second.window = 10
+        self.scheduler.fill(first, False)
+        self.assertEqual(len(first.outstanding), 9)
+        self.scheduler.fill(second, False)
+        self.assertEqual(second.outstanding, {})
+        self.scheduler.fill(second, True)
+        self.assertEqual(set(second.outstanding), set(first.outstanding))
+        second.control.clear()
+        self.deliver(first, 1, 2**14)
+        self.assertEqual(queued(second), struct.pack('!IBIII', 13, 8, 1, 2**14, 2**14))
+        self.assertNotIn((1, 2**14), second.outstanding)
+
+class TestAsync(unittest.TestCase):
+    def test_wait(self):
+        async def run():
+            wakeup = asyncio.Event()
+            wakeup.set()
+            since = time.time()
+            await wait(wakeup, since)
+            self.assertGreaterEqual(time.time() - since, PASS_INTERVAL)
+            self.assertFalse(wakeup.is_set())
+            since = time.time() - TICK
+            await wait(wakeup, since)
+            self.assertLess(time.time() - since, TICK + 0.2)
+        asyncio.run(run())
+
+    def test_closed_loop(self):
+        async def make():
+            return AsyncPeer(b'')
+        loop = asyncio.new_event_loop()
+        peer = loop.run_until_complete(make())
+        peer.connected = True
+        peer.close()
+        loop.close()
+        peer.send_have(1)
+        self.assertFalse(peer.control)
+
+    def test_peer_over_server(self):
+        async def run():
+            server = AsyncServer(0)
+            server.start()
+            wakeup = asyncio.Event()
+            handshake = b'\x13BitTorrent protocol' + b'\x00'*8 + b'h'*20
+            outgoing = AsyncPeer(handshake + b'o'*20, notify=wakeup.set)
+            outgoing.connect('127.0.0.1', server.port)
+            while not server.peers:
+                await asyncio.sleep(0.01)
+            incoming = AsyncPeer(handshake + b'i'*20, True, server.take_number_of_peers(1)[0])
+            while not incoming.handshaked:
+                await asyncio.sleep(0.01)
+            incoming.push(construct_message('have', 5))
+            while not outgoing.has_piece(5):
+                await asyncio.wait_for(wakeup.wait(), 1)
+                wakeup.clear()
+            self.assertTrue(incoming.handshaked)
+            self.assertTrue(outgoing.handshaked)
+            incoming.close()
+            await asyncio.sleep(0.05)
+            self.assertFalse(outgoing.alive)
+            server.close()
+        asyncio.run(run())
+
+    def test_announce(self):
+        async def run():
+            torrent = AsyncTorrent(0, -1)
+            torrent.handshake = b'hello'
+            tracker = mock.MagicMock()
+            tracker.can_reannounce.return_value = True
+            tracker.get_peers.return_value = [('127.0.0.1', 1)]*3
+            torrent.trackers = [tracker]
+            torrent.announce()
+            torrent.announce()
+            self.assertEqual(torrent.announcing, {tracker})
+            while torrent.announcing:
+                await asyncio.sleep(0.01)
+            self.assertEqual(tracker.get_peers.call_count, 1)
+            self.assertEqual(len(torrent.peers), 3)
+            for peer in torrent.peers:
+                peer.close()
+        asyncio.run(run())
+
+class TestDiskWriter(unittest.TestCase):
+    def setUp(self):
+        self.storage = mock.MagicMock()
+        self.file = {'path': 'a', 'length': 40, 'needed': True}
+        self.writer = DiskWriter(self.storage, max_size=25, fsync_interval=0)
+
+    def piece(self, index):
+        return index, [{'file': self.file, 'offset': index*10, 'length': 10, 'needed': True}], bytes([index])*10
+
+    def test_merge_and_sync(self):
+        with self.writer.condition:
+            for index in (1, 0, 3):
+                self.writer.put(*self.piece(index))
+            self.assertTrue(self.writer.full())
+            self.assertEqual(self.writer.depth(), 3)
+        self.writer.close()
+        self.assertFalse(self.writer.full())
+        self.assertEqual(sorted(self.writer.take_done()), [(0, None), (1, None), (3, None)])
+        calls = self.storage.write.call_args_list
+        self.assertEqual([x[0][0] for x in calls], [[{'file': self.file, 'offset': 0, 'length': 20, 'needed': True}],
+                                                    [{'file': self.file, 'offset': 30, 'length': 10, 'needed': True}]])
+        self.assertEqual(calls[0][0][1], [b'\x00'*10, b'\x01'*10])
+        self.storage.sync.assert_called_with({'a'})
+
+    def test_errors(self):
+        self.storage.write.side_effect = OSError
+        self.writer.put(*self.piece(2))
+        self.writer.close()
+        self.assertIsInstance(self.writer.take_done()[0][1], OSError)
+        self.assertEqual(self.writer.take_done(), [])
+
+class TestPieceCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = PieceCache(30, prefetch=0)
+        self.loaded = []
+
+    def load(self, index):
+        self.loaded.append(index)
+        return bytes([index])*10 if index < 6 else None
+
+    def test_lru(self):
+        for index in (0, 1, 0, 2, 3, 0, 9):
+            self.cache.get('a', index, self.load)
+        self.assertEqual(self.cache.get('a', 0, self.load), b'\x00'*10)
+        self.assertEqual(self.loaded, [0, 1, 2, 3, 9])
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 5))
+        self.assertEqual(list(self.cache.pieces), [('a', 2), ('a', 3), ('a', 0)])
+        self.assertEqual(self.cache.size, 30)
+        self.cache.get('b', 1, self.load)
+        self.cache.forget('a')
+        self.assertEqual((list(self.cache.pieces), self.cache.size), ([('b', 1)], 10))
+
+    def test_prefetch(self):
+        self.cache.prefetch_count = 2
+        self.cache.get('a', 4, self.load)
+        self.assertIsNone(self.cache.executor)
+        self.cache.get('a', 5, self.load)
+        self.cache.executor.shutdown(wait=True)
+        self.assertEqual(sorted(self.loaded), [4, 5, 6, 7])
+        self.assertEqual(self.cache.loading, set())
+        self.assertEqual(list(self.cache.pieces), [('a', 4), ('a', 5)])
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.storage = Storage(1)
+        self.files = [{'path': os.path.join(self.folder.name, name), 'length': 4, 'needed': True}
+                      for name in ('a', 'b')]
+
+    def tearDown(self):
+        self.storage.close()
+        self.folder.cleanup()
+
+    def test_write_read(self):
+        piece_map = [{'file': self.files[0], 'offset': 1, 'length': 3, 'needed': True},
+                     {'file': self.files[1], 'offset': 0, 'length': 4, 'needed': True}]
+        self.storage.write(piece_map, [b'ab', b'cdef', b'g'])
+        self.assertEqual(len(self.storage.handles), 1)
+        self.assertEqual(self.storage.read(piece_map), b'abcdefg')
+        with open(self.files[0]['path'], 'rb') as file_:
+            self.assertEqual(file_.read(), b'\x00abc')
+        piece_map[0]['needed'] = False
+        self.storage.write(piece_map, [b'1234567'])
+        self.assertEqual(self.storage.read(piece_map), b'abc4567')
+
+    def test_missing_file(self):
+        piece_map = [{'file': self.files[0], 'offset': 0, 'length': 4, 'needed': True}]
+        self.assertEqual(self.storage.read(piece_map), b'')
+        self.assertFalse(os.path.exists(self.files[0]['path']))
+        self.storage.write(piece_map, [b'ab'])
+        self.assertEqual(self.storage.read(piece_map), b'ab')
+
+    def test_read_only(self):
+        piece_map = [{'file': self.files[0], 'offset': 0, 'length': 4, 'needed': True}]
+        with open(self.files[0]['path'], 'wb') as file_:
+            file_.write(b'abcd')
+        with self.storage.handle(self.files[0]['path']) as fd:
+            self.assertRaises(OSError, os.pwrite, fd, b'x', 0)
+        self.assertEqual(self.storage.read(piece_map), b'abcd')
+        self.storage.write(piece_map, [b'efgh'])
+        self.assertEqual(self.storage.read(piece_map), b'efgh')
+        self.assertTrue(self.storage.handles[self.files[0]['path']][2])
+
+    def test_handle_in_use(self):
+        with self.storage.handle(self.files[0]['path'], True) as fd:
+            with self.storage.handle(self.files[1]['path'], True):
+                pass
+            os.pwrite(fd, b'x', 0)
+        self.assertEqual(list(self.storage.handles), [self.files[1]['path']])
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_mmap(self):
+        storage = MmapStorage()
+        storage.allocate(self.files[:1])
+        self.assertEqual(os.path.getsize(self.files[0]['path']), 4)
+        piece_map = [{'file': self.files[0], 'offset': 2, 'length': 2, 'needed': True},
+                     {'file': self.files[1], 'offset': 0, 'length': 3, 'needed': True}]
+        self.assertEqual(storage.read(piece_map), b'\x00\x00')
+        storage.write(piece_map, [b'ab', b'cde'])
+        self.assertEqual(storage.read(piece_map), b'abcde')
+        block = storage.read(piece_map[:1])
+        self.assertIsInstance(block, memoryview)
+        self.assertEqual(block, b'ab')
+        del block
+        storage.close()
+        with open(self.files[1]['path'], 'rb') as file_:
+            self.assertEqual(file_.read(), b'cde\x00')
+
+class TestPieceTable(unittest.TestCase):
+    def setUp(self):
+        self.pieces = PieceTable(bytes(range(20))*10, 4, 38)
+
+    def test_flags(self):
+        self.assertEqual(len(self.pieces), 10)
+        self.assertEqual(len(self.pieces.have), 2)
+        self.pieces.set_have(9)
+        self.pieces.set_have(2)
+        self.assertTrue(self.pieces.has(9))
+        self.assertFalse(self.pieces.has(8))
+        self.assertEqual(self.pieces.have, b'\x20\x40')
+        self.pieces.set_have(9, False)
+        self.assertEqual(self.pieces.have, b'\x20\x00')
+        self.assertEqual(self.pieces.size(9), 2)
+
+    def test_missing(self):
+        self.assertEqual(self.pieces.missing(), [])
+        for index in range(10):
+            self.pieces.set_needed(index, index != 4)
+        self.pieces.set_have(0)
+        self.pieces.set_have(8)
+        self.assertEqual(self.pieces.missing(), [1, 2, 3, 5, 6, 7, 9])
+        self.assertEqual(self.pieces.missing(b'\xFF'), [1, 2, 3, 5, 6, 7])
+        self.assertEqual(self.pieces.missing(b'\x0F\xC0\xFF'), [5, 6, 7, 9])
+
+    def test_validate(self):
+        pieces = PieceTable(sha1(b'foo').digest()+sha1(b'bar').digest(), 3, 6)
+        self.assertTrue(pieces.validate(1, b'bar'))
+        self.assertFalse(pieces.validate(0, b'bar'))
 
 class FilesTest(unittest.TestCase):
     def test_check_file(self):